@@ -7,8 +7,24 @@
 #
 
 from __future__ import annotations
+import os
 import sys
-from typing import List, Dict
+import json
+import gc
+import bisect
+import hashlib
+import marshal
+import shutil
+import io
+import time
+import contextlib
+import optparse
+import concurrent.futures
+from array import array
+from itertools import repeat
+from typing import List, Dict, Optional, Tuple
+
+import bfpp
 
 iota_counter = 0
 def iota(reset = False):
@@ -33,6 +49,12 @@ TOK_SWAP = iota()
 TOK_PRINT = iota()
 TOK_ADD  = iota()
 TOK_SUB  = iota()
+TOK_MUL  = iota()
+TOK_DIV  = iota()
+TOK_MOD  = iota()
+TOK_DIVMOD = iota()
+TOK_SHL  = iota()
+TOK_SHR  = iota()
 TOK_EQ   = iota()
 TOK_NEQ  = iota()
 TOK_GT   = iota()
@@ -51,6 +73,7 @@ TOK_ARRAY = iota()
 TOK_LOAD = iota()
 
 TOK_DBGPRINT = iota()
+TOK_STRING = iota()
 
 keyword_map = {
     "dup": TOK_DUP,
@@ -59,6 +82,12 @@ keyword_map = {
     "swap": TOK_SWAP,
     "add": TOK_ADD,
     "sub": TOK_SUB, 
+    "mul": TOK_MUL,
+    "div": TOK_DIV,
+    "mod": TOK_MOD,
+    "divmod": TOK_DIVMOD,
+    "shl": TOK_SHL,
+    "shr": TOK_SHR,
     "eq": TOK_EQ,
     "neq": TOK_NEQ,
     "gt": TOK_GT,
@@ -76,12 +105,14 @@ keyword_map = {
     "array": TOK_ARRAY,
     "array_get": TOK_ARRAY_GET,
     "array_set": TOK_ARRAY_SET,
+    "load": TOK_LOAD,
 
     "dbgprint": TOK_DBGPRINT,
 
 }
 
 class Token(object):
+    __slots__ = ("kind", "text", "line_number")
     kind: int
     text: str
     line_number: int
@@ -102,157 +133,354 @@ def is_name(word: str):
             return False
     return True
 
+def classify_word(word: str) -> Tuple[int, str]:
+    if word in keyword_map:
+        return keyword_map[word], word
+    elif is_name(word):
+        return TOK_SYMBOL, word
+    elif len(word) > 1 and word[0] == "?" and is_name(word[1:]):
+        return TOK_ARRAY_GET, word[1:]
+    elif len(word) > 1 and word[0] == "!" and is_name(word[1:]):
+        return TOK_ARRAY_SET, word[1:]
+    elif word.isdigit():
+        return TOK_INT, word
+    elif len(word) > 1 and word[0] == "\"" and word[-1] == "\"":
+        return TOK_STRING, word[1:-1]
+    return TOK_INVALID, word
+
+class Tokens(object):
+    # The tokens of a source as parallel arrays instead of one Token each:
+    # token i is texts[i] of kind kinds[i] at line lines[i]. Every distinct
+    # word is classified once and its text is shared by all its tokens.
+    # Indexing makes a Token, slicing gives Tokens
+    __slots__ = ("kinds", "texts", "lines")
+
+    def __init__(self, kinds: array, texts: List[str], lines: array):
+        self.kinds = kinds
+        self.texts = texts
+        self.lines = lines
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Tokens(self.kinds[i], self.texts[i], self.lines[i])
+        return Token(self.kinds[i], self.texts[i], self.lines[i])
 
-def parse_tokens(source: str) -> List[Token]:
-    result = []
-    for line_number, line in enumerate(source.splitlines()):
-        if line.strip().startswith(";"):
+    def __repr__(self):
+        return f"Tokens({list(self)})"
+
+def parse_tokens(source: str, first_line: int = 1) -> Tokens:
+    # Split in one go, the only Python loop is per line. The words are
+    # classified and mapped to kinds and texts with `map`
+    words = []
+    lines = array("I")
+    for line_number, line in enumerate(source.splitlines(), first_line):
+        line = line.split()
+        if len(line) == 0 or line[0][0] == ";":
             continue
-
-        for word in line.split():
-            if word in keyword_map:
-                result.append(Token(kind=keyword_map[word], text=word, line_number=line_number + 1))
-            elif is_name(word):
-                result.append(Token(kind=TOK_SYMBOL, text=word, line_number=line_number + 1))
-            elif word[0] == "?" and is_name(word[1:]):
-                result.append(Token(kind=TOK_ARRAY_GET, text=word[1:], line_number=line_number + 1))
-            elif word[0] == "!" and is_name(word[1:]):
-                result.append(Token(kind=TOK_ARRAY_SET, text=word[1:], line_number=line_number + 1))
-            elif word.isdigit():
-                result.append(Token(kind=TOK_INT, text=word, line_number=line_number + 1))
-            else:
-                result.append(Token(kind=TOK_INVALID, text=word, line_number=line_number + 1))
-    return result
+        words += line
+        lines.extend(repeat(line_number, len(line)))
+    kind_of, text_of = {}, {}
+    for word in set(words):
+        kind_of[word], text_of[word] = classify_word(word)
+    return Tokens(array("B", map(kind_of.__getitem__, words)), list(map(text_of.__getitem__, words)), lines)
 
 class Inst(object):
-    pass
+    # The source line the instruction comes from, 0 when the compiler made
+    # it up, and the path of the loaded module it is in or "" for the file
+    # being compiled. Programs have millions of instructions so none of
+    # them keeps a __dict__
+    __slots__ = ("line_number", "file")
+    line_number: int
+    file: str
 
 class Integer(Inst):
+    __slots__ = ("value",)
     value: int
-    def __init__(self, value: int):
+    def __init__(self, value: int, line_number: int = 0, file: str = ""):
         self.value = value
+        self.line_number = line_number
+        self.file = file
 
     def __repr__(self):
         return f"Integer({self.value})"
 
 class Intrinsic(Inst):
+    __slots__ = ("kind",)
     kind: str
-    def __init__(self, kind: str):
+    def __init__(self, kind: str, line_number: int = 0, file: str = ""):
         self.kind = kind
+        self.line_number = line_number
+        self.file = file
 
     def __repr__(self):
         return self.kind
 
 class ArrayOp(Inst):
-    def __init__(self, name: str, is_get: bool):
+    __slots__ = ("name", "is_get")
+    name: str
+    is_get: bool
+
+    def __init__(self, name: str, is_get: bool, line_number: int = 0, file: str = ""):
         self.name = name
         self.is_get = is_get
+        self.line_number = line_number
+        self.file = file
+
+    def __repr__(self):
+        return f"{'?' if self.is_get else '!'}{self.name}"
 
 class While(Inst):
+    __slots__ = ("cond", "body")
     cond: List[Inst]
     body: List[Inst]
     line_number: int
 
-    def __init__(self, cond: List[Inst], body: List[Inst], line_number: int):
+    def __init__(self, cond: List[Inst], body: List[Inst], line_number: int, file: str = ""):
         self.cond = cond
         self.body = body
         self.line_number = line_number
+        self.file = file
 
     def __repr__(self):
         return f"While(cond={self.cond}, body={self.body})"
 
 class Branch(Inst):
+    __slots__ = ("cond", "if_body", "else_body")
     cond: List[Inst]
     if_body: List[Inst]
     else_body: List[Inst]
     line_number: int
     
-    def __init__(self, cond: List[Inst], if_body: List[Inst], else_body: List[Inst], line_number: int):
+    def __init__(self, cond: List[Inst], if_body: List[Inst], else_body: List[Inst], line_number: int, file: str = ""):
         self.cond = cond
         self.if_body = if_body
         self.else_body = else_body
         self.line_number = line_number
+        self.file = file
 
     def __repr__(self):
         return f"Branch(cond={self.cond}, if={self.if_body}, else={self.else_body})"
 
+class Block(Inst):
+    __slots__ = ("body",)
+    body: List[Inst]
+    line_number: int
+
+    # The body of an if/else whose condition is known at compile time.
+    # It runs two cells past the stack top just like the bodies of Branch.
+    def __init__(self, body: List[Inst], line_number: int, file: str = ""):
+        self.body = body
+        self.line_number = line_number
+        self.file = file
+
+    def __repr__(self):
+        return f"Block(body={self.body})"
+
+class Fused(Inst):
+    __slots__ = ("kind", "value")
+    kind: str
+    value: int
+
+    # A superinstruction that fuse_stack_ops made out of a common sequence
+    # of intrinsics, see Codegen.emit_fused
+    def __init__(self, kind: str, value: int = 0, line_number: int = 0, file: str = ""):
+        self.kind = kind
+        self.value = value
+        self.line_number = line_number
+        self.file = file
+
+    def __repr__(self):
+        return f"Fused({self.kind}, {self.value})"
+
+class Macro(object):
+    # A def. Using a macro splices its body in, except for the part from
+    # its first while or if to the end of its last one: that part goes in
+    # as an Expansion shared by every use, so the passes work on it once
+    # and Codegen emits it once for every tape it gets entered with
+    __slots__ = ("name", "body", "head", "shared", "tail", "derived")
+
+    def __init__(self, name: str, body: List[Inst]):
+        self.name = name
+        self.body = body
+        blocks = [ i for i, inst in enumerate(body) if is_block(inst) ]
+        first, last = (blocks[0], blocks[-1] + 1) if len(blocks) > 0 else (len(body), len(body))
+        self.head = body[:first]
+        self.shared = body[first:last]
+        self.tail = body[last:]
+        # (pass, id of the body it ran on) to (that body, what it made)
+        self.derived = {}
+
+    def derive(self, name: str, body: List[Inst], make) -> List[Inst]:
+        key = (name, id(body))
+        if key not in self.derived:
+            self.derived[key] = (body, make(body))
+        return self.derived[key][1]
+
+    def __repr__(self):
+        return f"Macro({self.name}, {self.body})"
+
+class Expansion(Inst):
+    __slots__ = ("macro", "body")
+    macro: Macro
+    body: List[Inst]
+
+    # A use of the shared part of a macro. body starts and ends with a
+    # while or an if, so no pass or template looks across its boundaries
+    def __init__(self, macro: Macro, body: List[Inst], line_number: int = 0, file: str = ""):
+        self.macro = macro
+        self.body = body
+        self.line_number = line_number
+        self.file = file
+
+    def __repr__(self):
+        return f"Expansion({self.macro.name}, {self.body})"
+
+def is_block(inst: Inst) -> bool:
+    return isinstance(inst, (While, Branch, Block, Expansion))
+
 class ArraySpec(object):
     def __init__(self, size: int, offset: int):
         self.size = size
         self.offset = offset
 
+    def footprint(self) -> int:
+        return (self.size + ARRAY_HEADER) * ARRAY_STRIDE
+
     def __repr__(self):
         return f"ArraySpec(size={self.size}, offset={self.offset})"
 
 class Program(object):
-    def __init__(self, body: List[Inst], macros: Dict[str, List[Inst]], arrays: Dict[str, ArraySpec]):
+    def __init__(self, body: List[Inst], macros: Dict[str, Macro], arrays: Dict[str, ArraySpec]):
         self.body   = body
         self.macros = macros
         self.arrays = arrays
         self.offset = 0
+        # First and last line of each macro definition
+        self.macro_lines = {}
 
     def __repr__(self):
         return f"Program(body={self.body}, macros={self.macros}, offset={self.offset})"
 
 class Parser(object):
-    def __init__(self, tokens: List[Token]):
+    # Reads the token arrays directly instead of making a Token for each.
+    # `load` paths are relative to directory, loading has the modules
+    # being loaded so a cycle is reported and `loads` gets the path and key
+    # of every module the source loads, also through other modules. file
+    # is the path of the module being parsed, see Inst
+    def __init__(self, tokens: Tokens, directory: str = ".", loading: Tuple[str, ...] = (), file: str = ""):
         self.program = Program([], {}, {})
         self.blocks = [self.program.body]
         self.tokens = tokens
+        self.kinds = tokens.kinds
+        self.lines = tokens.lines
+        self.texts = tokens.texts
         self.i = 0
+        self.directory = directory
+        self.loading = loading
+        self.loads = []
+        self.file = file
 
     def parse_once(self):
-        if self.tokens[self.i].kind == TOK_WHILE:
+        # Plain words first, they are most of the tokens
+        i = self.i
+        kind = self.kinds[i]
+        if kind == TOK_INT:
+            self.blocks[-1].append(Integer(int(self.texts[i]), self.lines[i], self.file))
+            self.i += 1
+        elif kind == TOK_SYMBOL:
+            macro = self.expand_macro(self.texts[i])
+            block = self.blocks[-1]
+            block.extend(macro.head)
+            if len(macro.shared) > 0:
+                block.append(Expansion(macro, macro.shared, self.lines[i], self.file))
+            block.extend(macro.tail)
+            self.i += 1
+        elif kind == TOK_WHILE:
             self.parse_while()
-        elif self.tokens[self.i].kind == TOK_DEF:
+        elif kind == TOK_DEF:
             self.parse_macro()
-        elif self.tokens[self.i].kind == TOK_ARRAY:
+        elif kind == TOK_ARRAY:
             self.parse_array()
-        elif self.tokens[self.i].kind == TOK_SYMBOL:
-            name = self.tokens[self.i]
-            if name.text not in self.program.macros:
-                error(f"Unknown macro {name.text} to expand")
-            self.blocks[-1].extend(self.program.macros[name.text])
-        elif self.tokens[self.i].kind == TOK_IF:
+        elif kind == TOK_IF:
             self.parse_if()
-        elif self.tokens[self.i].kind in [ TOK_DO, TOK_END, TOK_ELSE ]:
-            error(f"invalid token '{self.tokens[self.i].text}' at line {self.tokens[self.i].line_number}. It has no context")
-        elif self.tokens[self.i].kind == TOK_INT:
-            self.blocks[-1].append(Integer(int(self.tokens[self.i].text)))
-            self.i += 1
-        elif self.tokens[self.i].text in keyword_map:
-            self.blocks[-1].append(Intrinsic(self.tokens[self.i].text))
+        elif kind == TOK_LOAD:
+            self.parse_load()
+        elif kind == TOK_DO or kind == TOK_END or kind == TOK_ELSE:
+            error(f"invalid token '{self.texts[i]}' at line {self.lines[i]}. It has no context")
+        elif kind != TOK_INVALID and self.texts[i] in keyword_map:
+            self.blocks[-1].append(Intrinsic(self.texts[i], self.lines[i], self.file))
             self.i += 1
-        elif self.tokens[self.i].kind == TOK_ARRAY_GET:
-            self.blocks[-1].append(ArrayOp(self.tokens[self.i].text, True))
+        elif kind == TOK_ARRAY_GET:
+            self.blocks[-1].append(ArrayOp(self.texts[i], True, self.lines[i], self.file))
             self.i += 1
-        elif self.tokens[self.i].kind == TOK_ARRAY_SET:
-            self.blocks[-1].append(ArrayOp(self.tokens[self.i].text, False))
+        elif kind == TOK_ARRAY_SET:
+            self.blocks[-1].append(ArrayOp(self.texts[i], False, self.lines[i], self.file))
             self.i += 1
         else:
-            error(f"invalid token '{self.tokens[self.i].text}' at line {self.tokens[self.i].line_number}")
+            error(f"invalid token '{self.texts[i]}' at line {self.lines[i]}")
+
+    def expand_macro(self, name: str) -> Macro:
+        if name not in self.program.macros:
+            error(f"Unknown macro {name} to expand")
+        return self.program.macros[name]
+
+    def parse_condition_token(self, condition: List[Inst]):
+        i = self.i
+        kind = self.kinds[i]
+        if kind == TOK_INT:
+            condition.append(Integer(int(self.texts[i]), self.lines[i], self.file))
+        elif kind != TOK_INVALID and self.texts[i] in keyword_map:
+            condition.append(Intrinsic(self.texts[i], self.lines[i], self.file))
+        elif kind == TOK_SYMBOL:
+            condition.extend(self.expand_macro(self.texts[i]).body)
+        elif kind == TOK_ARRAY_GET or kind == TOK_ARRAY_SET:
+            condition.append(ArrayOp(self.texts[i], kind == TOK_ARRAY_GET, self.lines[i], self.file))
 
     def parse_array(self):
-        array_tok = self.tokens[self.i]
+        array_line = self.lines[self.i]
         self.i += 1
         name = self.tokens[self.i]
         if name.kind != TOK_SYMBOL:
             error(f"To define an array it must have the following pattern \"array <array-name> <array-size> end\"\n" +
-                  f"At line {array_tok.line_number} expecting <array-name> to be a symbol token but found {name.kind} {name.text}")
+                  f"At line {array_line} expecting <array-name> to be a symbol token but found {name.kind} {name.text}")
         self.i += 1
         size = self.tokens[self.i]
         if size.kind != TOK_INT:
             error(f"To define an array it must have the following pattern \"array <array-name> <array-size> end\"\n" +
-                  f"At line {array_tok.line_number} expecting <array-size> to be an integer token but found {size.kind} {size.text}")
+                  f"At line {array_line} expecting <array-size> to be an integer token but found {size.kind} {size.text}")
         self.i += 1
-        if self.tokens[self.i].kind != TOK_END:
+        if self.kinds[self.i] != TOK_END:
             error(f"To define an array it must have the following pattern \"array <array-name> <array-size> end\"\n" +
-                  f"At line {array_tok.line_number} expecting token end but found {size.kind} {size.text}")
+                  f"At line {array_line} expecting token end but found {size.kind} {size.text}")
         array = ArraySpec(int(size.text), self.program.offset)
-        self.program.offset += array.size
+        self.program.offset += array.footprint()
         self.program.arrays[name.text] = array
         self.i += 1
 
+    def parse_load(self):
+        load_line = self.lines[self.i]
+        if len(self.blocks) > 1:
+            error(f"'load' at line {load_line} has to be outside of any def, while or if")
+        self.i += 1
+        path = self.tokens[self.i]
+        if path.kind != TOK_STRING:
+            error(f"Expecting a path in double quotes after 'load' in line {load_line} found {path.text}")
+        module = load_module(os.path.join(self.directory, path.text), self.loading, load_line)
+        self.loads.append((module.path, module.key))
+        self.loads.extend(module.deps)
+        self.program.macros.update(module.macros)
+        for name, size in module.arrays:
+            # Already there when two loaded modules load the same one
+            if name in self.program.arrays and self.program.arrays[name].size == size:
+                continue
+            array = ArraySpec(size, self.program.offset)
+            self.program.offset += array.footprint()
+            self.program.arrays[name] = array
+        self.i += 1
+
     def parse_macro(self):
         # TODO(bagasjs): Make sure we can't add a while or if else block in macro
         #                because it can be expanded into illegal instruction at 
@@ -261,149 +489,1139 @@ class Parser(object):
         #                this wil be expanded into while while 1 1 eq do end do end
         #                Which for now will be illegal until further research done 
         #                (Although I don't want to research about this)
-        macro_tok = self.tokens[self.i]
+        macro_line = self.lines[self.i]
         self.i += 1
         name = self.tokens[self.i]
         if name.kind != TOK_SYMBOL:
-            error(f"Expecting a symbol/name after 'def' in {macro_tok.line_number} found {name.text} {name.kind}")
+            error(f"Expecting a symbol/name after 'def' in {macro_line} found {name.text} {name.kind}")
         self.i += 1
         self.blocks.append([])
-        while self.tokens[self.i].kind != TOK_END:
-            if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_END:
-                error(f"invalid eof expecting 'end' for 'macro' in line {macro_tok.line_number}")
-            self.parse_once()
+        self.parse_until(TOK_END, TOK_END, f"invalid eof expecting 'end' for 'macro' in line {macro_line}")
 
         body = self.blocks[-1]
         self.blocks.pop()
-        self.program.macros[name.text] = body
+        self.program.macros[name.text] = Macro(name.text, body)
+        self.program.macro_lines[name.text] = (macro_line, self.lines[self.i])
         self.i += 1
         pass
 
-    def parse_if(self):
-        if_tok = self.tokens[self.i]
+    def parse_until(self, stop: int, other: int, eof: str):
+        # Parse up to the next token of kind stop or other at this level
+        kinds = self.kinds
+        last = len(kinds) - 1
+        while kinds[self.i] != stop and kinds[self.i] != other:
+            if self.i >= last:
+                error(eof)
+            self.parse_once()
+
+    def parse_condition(self, what: str, line: int) -> List[Inst]:
         condition = []
-        self.i += 1
-        while self.tokens[self.i].kind != TOK_DO:
-            if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_DO:
-                error(f"invalid eof expecting 'do' for 'if' in line {if_tok.line_number}")
-            if self.tokens[self.i].kind in [ TOK_WHILE, TOK_IF, TOK_END, TOK_ELSE, TOK_DO ]:
-                error(f"invalid token '{self.tokens[self.i].text}' in an if condition at line {self.tokens[self.i].line_number}")
-            elif self.tokens[self.i].kind == TOK_INT:
-                condition.append(Integer(int(self.tokens[self.i].text)))
-            elif self.tokens[self.i].text in keyword_map:
-                condition.append(Intrinsic(self.tokens[self.i].text))
+        kinds = self.kinds
+        last = len(kinds) - 1
+        while kinds[self.i] != TOK_DO:
+            kind = kinds[self.i]
+            if self.i >= last:
+                error(f"invalid eof expecting 'do' for '{what}' in line {line}")
+            if kind == TOK_WHILE or kind == TOK_IF or kind == TOK_END or kind == TOK_ELSE or kind == TOK_LOAD:
+                error(f"invalid token '{self.texts[self.i]}' in {'an' if what == 'if' else 'a'} {what} condition at line {self.lines[self.i]}")
+            self.parse_condition_token(condition)
             self.i += 1
+        self.i += 1
+        return condition
 
+    def parse_if(self):
+        if_line = self.lines[self.i]
         self.i += 1
+        condition = self.parse_condition("if", if_line)
         self.blocks.append([])
-        while not (self.tokens[self.i].kind == TOK_END or self.tokens[self.i].kind == TOK_ELSE):
-            if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_END:
-                error(f"invalid eof expecting 'end' for 'if' in line {if_tok.line_number}")
-            self.parse_once()
+        self.parse_until(TOK_END, TOK_ELSE, f"invalid eof expecting 'end' for 'if' in line {if_line}")
         if_body = self.blocks[-1]
         self.blocks.pop()
 
         else_body = []
-        if self.tokens[self.i].kind == TOK_ELSE:
+        if self.kinds[self.i] == TOK_ELSE:
             self.blocks.append(else_body)
-            else_tok = self.tokens[self.i]
+            else_line = self.lines[self.i]
             self.i += 1
-            while self.tokens[self.i].kind != TOK_END:
-                if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_END:
-                    error(f"invalid eof expecting 'end' for 'else' in line {else_tok.line_number}")
-                self.parse_once()
+            self.parse_until(TOK_END, TOK_END, f"invalid eof expecting 'end' for 'else' in line {else_line}")
             self.blocks.pop()
-        self.blocks[-1].append(Branch(condition, if_body, else_body, if_tok.line_number))
+        self.blocks[-1].append(Branch(condition, if_body, else_body, if_line, self.file))
         self.i += 1
 
     def parse_while(self):
-        while_tok = self.tokens[self.i]
-        condition = []
-        self.i += 1
-        while self.tokens[self.i].kind != TOK_DO:
-            if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_DO:
-                error(f"invalid eof expecting 'do' for 'while' in line {while_tok.line_number}")
-            if self.tokens[self.i].kind in [ TOK_WHILE, TOK_IF, TOK_END, TOK_ELSE, TOK_DO ]:
-                error(f"invalid token '{self.tokens[self.i].text}' in a while condition at line {self.tokens[self.i].line_number}")
-            elif self.tokens[self.i].kind == TOK_INT:
-                condition.append(Integer(int(self.tokens[self.i].text)))
-            elif self.tokens[self.i].text in keyword_map:
-                condition.append(Intrinsic(self.tokens[self.i].text))
-            self.i += 1
+        while_line = self.lines[self.i]
         self.i += 1
+        condition = self.parse_condition("while", while_line)
         self.blocks.append([])
-        while self.tokens[self.i].kind != TOK_END:
-            if self.i + 1 >= len(self.tokens) and self.tokens[self.i].kind != TOK_END:
-                error(f"invalid eof expecting 'end' for 'while' in line {while_tok.line_number}")
-            self.parse_once()
+        self.parse_until(TOK_END, TOK_END, f"invalid eof expecting 'end' for 'while' in line {while_line}")
         body = self.blocks[-1]
         self.blocks.pop()
-        self.blocks[-1].append(While(condition, body, while_tok.line_number))
+        self.blocks[-1].append(While(condition, body, while_line, self.file))
         self.i += 1
 
     def parse(self):
-        while self.i < len(self.tokens):
-            self.parse_once()
+        # The instructions don't reference each other in cycles, so the
+        # cycle collector is paused instead of walking them over and over
+        # while millions of them are made
+        paused = gc.isenabled()
+        gc.disable()
+        count = len(self.kinds)
+        try:
+            while self.i < count:
+                self.parse_once()
+        except IndexError:
+            # A def, while, if or array still open reads past the last token
+            if self.i < count:
+                raise
+            error(f"unexpected end of file after line {self.lines[-1]}")
+        finally:
+            if paused:
+                gc.enable()
+
+# Modules
+#
+# `load "path"` brings in the macros and arrays of another source, which
+# may only define them and load other modules. A module is parsed on its
+# own, without the macros of whoever loads it, and what it defines is
+# kept next to it in a .bfm file: a marshal dump of its macro table keyed
+# by a hash of its source and of the compiler, plus the keys of every
+# module it loaded. Loading a module whose .bfm is still valid reads and
+# hashes the source but doesn't tokenize or parse it.
+MODULE_VERSION = 2
+# Modules already loaded in this process, by path and key
+loaded_modules = {}
+
+class Module(object):
+    def __init__(self, path: str, key: str, macros: Dict[str, Macro], arrays: List[Tuple[str, int]],
+                 deps: List[Tuple[str, str]]):
+        self.path = path
+        self.key = key
+        self.macros = macros
+        self.arrays = arrays
+        # (path, key) of the modules it loaded, also through other modules
+        self.deps = deps
+
+def module_artifact(path: str) -> str:
+    return os.path.splitext(path)[0] + ".bfm"
+
+def module_key(source: str) -> str:
+    key = hashlib.sha256(compiler_hash().encode())
+    key.update(source.encode())
+    return key.hexdigest()
+
+def module_changed(path: str, key: str) -> bool:
+    try:
+        with open(path, "r") as file:
+            return module_key(file.read()) != key
+    except OSError:
+        return True
+
+def encode_insts(insts: List[Inst], table: list, indices: Dict[int, int], files: Dict[str, int]) -> list:
+    # Instructions as tuples of builtin types, an Expansion refers to the
+    # index of its macro in table and every instruction ends with the
+    # index of its file in files
+    out = []
+    for inst in insts:
+        file = files.setdefault(inst.file, len(files))
+        if isinstance(inst, Integer):
+            out.append((0, inst.value, inst.line_number, file))
+        elif isinstance(inst, Intrinsic):
+            out.append((1, inst.kind, inst.line_number, file))
+        elif isinstance(inst, ArrayOp):
+            out.append((2, inst.name, inst.is_get, inst.line_number, file))
+        elif isinstance(inst, While):
+            out.append((3, encode_insts(inst.cond, table, indices, files), encode_insts(inst.body, table, indices, files),
+                        inst.line_number, file))
+        elif isinstance(inst, Branch):
+            out.append((4, encode_insts(inst.cond, table, indices, files), encode_insts(inst.if_body, table, indices, files),
+                        encode_insts(inst.else_body, table, indices, files), inst.line_number, file))
+        elif isinstance(inst, Expansion):
+            out.append((5, encode_macro(inst.macro, table, indices, files), inst.line_number, file))
+    return out
+
+def encode_macro(macro: Macro, table: list, indices: Dict[int, int], files: Dict[str, int]) -> int:
+    # The macros a body expands come before it in table
+    if id(macro) not in indices:
+        body = encode_insts(macro.body, table, indices, files)
+        indices[id(macro)] = len(table)
+        table.append((macro.name, body))
+    return indices[id(macro)]
+
+def decode_insts(insts: list, macros: List[Macro], files: List[str]) -> List[Inst]:
+    out = []
+    for inst in insts:
+        kind = inst[0]
+        file = files[inst[-1]]
+        if kind == 0:
+            out.append(Integer(inst[1], inst[2], file))
+        elif kind == 1:
+            out.append(Intrinsic(inst[1], inst[2], file))
+        elif kind == 2:
+            out.append(ArrayOp(inst[1], inst[2], inst[3], file))
+        elif kind == 3:
+            out.append(While(decode_insts(inst[1], macros, files), decode_insts(inst[2], macros, files), inst[3], file))
+        elif kind == 4:
+            out.append(Branch(decode_insts(inst[1], macros, files), decode_insts(inst[2], macros, files),
+                              decode_insts(inst[3], macros, files), inst[4], file))
+        elif kind == 5:
+            macro = macros[inst[1]]
+            out.append(Expansion(macro, macro.shared, inst[2], file))
+    return out
+
+def save_module(module: Module):
+    # The files of the instructions are kept relative to the module, they
+    # are the module itself and the modules it loaded
+    table, indices, files = [], {}, {}
+    names = [ (name, encode_macro(macro, table, indices, files)) for name, macro in module.macros.items() ]
+    directory = os.path.dirname(module.path)
+    paths = [ os.path.relpath(file, directory) for file in files ]
+    data = marshal.dumps((MODULE_VERSION, module.key, module.deps, table, names, module.arrays, paths))
+    artifact = module_artifact(module.path)
+    try:
+        temp = f"{artifact}.{os.getpid()}.tmp"
+        with open(temp, "wb") as file:
+            file.write(data)
+        os.replace(temp, artifact)
+    except OSError:
+        pass
+
+def read_module(path: str, key: str) -> Optional[Module]:
+    # The module in the .bfm next to path, if it is there and its key
+    # still matches
+    try:
+        with open(module_artifact(path), "rb") as file:
+            version, saved_key, deps, table, names, arrays, paths = marshal.loads(file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != MODULE_VERSION or saved_key != key:
+        return None
+    files = [ os.path.normpath(os.path.join(os.path.dirname(path), file)) for file in paths ]
+    macros = []
+    for name, body in table:
+        macros.append(Macro(name, decode_insts(body, macros, files)))
+    return Module(path, key, { name: macros[index] for name, index in names }, arrays, deps)
+
+def load_module(path: str, loading: Tuple[str, ...] = (), line_number: int = 0) -> Module:
+    path = os.path.abspath(path)
+    if path in loading:
+        error(f"'load' at line {line_number} of {loading[-1]} loads {path} which is already being loaded")
+    try:
+        with open(path, "r") as file:
+            source = file.read()
+    except OSError as e:
+        error(f"'load' at line {line_number} can't read {path}: {e.strerror}")
+    key = module_key(source)
+    module = loaded_modules.get((path, key))
+    if module is None:
+        module = read_module(path, key)
+    # Stale when one of the modules it loaded changed since
+    if module is not None and any(module_changed(dep, dep_key) for dep, dep_key in module.deps):
+        module = None
+    if module is None:
+        parser = Parser(parse_tokens(source), os.path.dirname(path), loading + (path,), path)
+        try:
+            parser.parse()
+            if len(parser.program.body) > 0:
+                error(f"Only def, array and load can be used in a loaded module, found code at line {parser.program.body[0].line_number}")
+        except SystemExit:
+            print(f"       in {path}")
+            raise
+        program = parser.program
+        module = Module(path, key, program.macros, [ (name, array.size) for name, array in program.arrays.items() ],
+                        list(dict.fromkeys(parser.loads)))
+        save_module(module)
+    loaded_modules[(path, key)] = module
+    return module
+
+# Constant folding
+#
+# Runs between Parser.parse and Codegen.emit_all. A value is known when
+# it is an Integer at the end of the instructions folded so far, so any
+# intrinsic whose operands are all known is replaced by its result.
+def divide(y: int, x: int) -> Tuple[int, int]:
+    # Dividing by 0 gives 0 and leaves the whole dividend as remainder,
+    # the same as the divmod template
+    return (y // x, y % x) if x != 0 else (0, y)
+
+FOLDABLE_BINARY = {
+    "add": lambda y, x: (y + x) & 0xFF,
+    "sub": lambda y, x: (y - x) & 0xFF,
+    "mul": lambda y, x: (y * x) & 0xFF,
+    "div": lambda y, x: divide(y, x)[0],
+    "mod": lambda y, x: divide(y, x)[1],
+    "shl": lambda y, x: (y << x) & 0xFF,
+    "shr": lambda y, x: y >> x,
+    "eq":  lambda y, x: int(y == x),
+    "neq": lambda y, x: int(y != x),
+    "gt":  lambda y, x: int(y > x),
+    "lt":  lambda y, x: int(y < x),
+    "and": lambda y, x: int(y != 0 and x != 0),
+    "or":  lambda y, x: int(y != 0 or x != 0),
+}
+
+def is_known(out: List[Inst], count: int) -> bool:
+    return len(out) >= count and all(isinstance(inst, Integer) for inst in out[len(out) - count:])
+
+def fold_intrinsic(out: List[Inst], inst: Intrinsic):
+    kind = inst.kind
+    if kind in FOLDABLE_BINARY and is_known(out, 2):
+        x = out.pop().value
+        y = out.pop().value
+        out.append(Integer(FOLDABLE_BINARY[kind](y, x), inst.line_number, inst.file))
+    elif kind == "divmod" and is_known(out, 2):
+        x = out.pop().value
+        y = out.pop().value
+        out.extend(Integer(value, inst.line_number, inst.file) for value in divide(y, x))
+    elif kind in ("add", "sub") and is_known(out, 1) and out[-1].value == 0:
+        out.pop()
+    elif kind == "dup" and is_known(out, 1):
+        out.append(Integer(out[-1].value, inst.line_number, inst.file))
+    elif kind == "over" and is_known(out, 2):
+        out.append(Integer(out[-2].value, inst.line_number, inst.file))
+    elif kind == "swap" and is_known(out, 2):
+        out[-2], out[-1] = out[-1], out[-2]
+    elif kind == "pop" and is_known(out, 1):
+        out.pop()
+    else:
+        out.append(inst)
+
+def fold_branch(out: List[Inst], branch: Branch):
+    if_body = fold_constants(branch.if_body)
+    else_body = fold_constants(branch.else_body)
+    # The condition is emitted right before the branch so it can also
+    # consume values known before it, e.g. `0 if 1 eq do`
+    start = len(out)
+    while start > 0 and isinstance(out[start - 1], Integer):
+        start -= 1
+    trial = out[start:]
+    for inst in branch.cond:
+        if isinstance(inst, Intrinsic):
+            fold_intrinsic(trial, inst)
+        else:
+            trial.append(inst)
+    if not trial or not isinstance(trial[-1], Integer):
+        out.append(Branch(fold_constants(branch.cond), if_body, else_body, branch.line_number, branch.file))
+        return
+    value = trial.pop().value
+    out[start:] = trial
+    body = if_body if value != 0 else else_body
+    if len(body) > 0:
+        out.append(Block(body, branch.line_number, branch.file))
+
+def is_false(cond: List[Inst]) -> bool:
+    return len(cond) == 1 and isinstance(cond[0], Integer) and cond[0].value == 0
+
+def fold_expansion(out: List[Inst], expansion: Expansion):
+    # The shared part folds the same at every use unless it starts with
+    # an if that can take values known before it (or a while that folds
+    # away, leaving what comes after it first) or folding removed the while
+    # or if at one of its ends. Those uses fold the instructions in place
+    body = expansion.macro.derive("fold", expansion.body, fold_constants)
+    first = expansion.body[0]
+    keeps_first = isinstance(first, While) and not is_false(fold_constants(first.cond))
+    if (len(body) > 0 and is_block(body[0]) and is_block(body[-1]) and
+            (keeps_first or not is_known(out, 1))):
+        out.append(Expansion(expansion.macro, body, expansion.line_number, expansion.file))
+        return
+    for inst in expansion.body:
+        fold_inst(out, inst)
+
+def fold_inst(out: List[Inst], inst: Inst):
+    if isinstance(inst, Intrinsic):
+        fold_intrinsic(out, inst)
+    elif isinstance(inst, While):
+        cond = fold_constants(inst.cond)
+        if is_false(cond):
+            return
+        out.append(While(cond, fold_constants(inst.body), inst.line_number, inst.file))
+    elif isinstance(inst, Branch):
+        fold_branch(out, inst)
+    elif isinstance(inst, Block):
+        out.append(Block(fold_constants(inst.body), inst.line_number, inst.file))
+    elif isinstance(inst, Expansion):
+        fold_expansion(out, inst)
+    else:
+        out.append(inst)
+
+def fold_constants(insts: List[Inst]) -> List[Inst]:
+    out = []
+    for inst in insts:
+        fold_inst(out, inst)
+    return out
+
+# Stack peephole
+#
+# Runs after constant folding. Shuffles that leave the stack as it was are
+# dropped and a few common sequences become a single Fused instruction:
+# - `over over` is "2dup", both values are copied without clearing the
+#   scratch cells in between
+# - `dup N lt` and `dup N gt` are "dup_lt" and "dup_gt". Usually the
+#   condition of a while or an if, they compare while moving the value
+#   back instead of copying it first and comparing the copy after
+STACK_NOOPS = [ [ "dup", "pop" ], [ "over", "pop" ], [ "swap", "swap" ] ]
+FUSED_COMPARES = { "lt": "dup_lt", "gt": "dup_gt" }
+
+def is_compare(inst: Inst) -> bool:
+    return isinstance(inst, Fused) and inst.kind in FUSED_COMPARES.values()
+
+def is_intrinsic(inst: Inst, *kinds: str) -> bool:
+    return isinstance(inst, Intrinsic) and inst.kind in kinds
+
+def fuse_stack_ops(insts: List[Inst]) -> List[Inst]:
+    out = []
+    for inst in insts:
+        if isinstance(inst, While):
+            inst = While(fuse_stack_ops(inst.cond), fuse_stack_ops(inst.body), inst.line_number, inst.file)
+        elif isinstance(inst, Branch):
+            inst = Branch(fuse_stack_ops(inst.cond), fuse_stack_ops(inst.if_body),
+                          fuse_stack_ops(inst.else_body), inst.line_number, inst.file)
+        elif isinstance(inst, Block):
+            inst = Block(fuse_stack_ops(inst.body), inst.line_number, inst.file)
+        elif isinstance(inst, Expansion):
+            inst = Expansion(inst.macro, inst.macro.derive("fuse", inst.body, fuse_stack_ops), inst.line_number, inst.file)
+        out.append(inst)
+
+        if (len(out) >= 2 and isinstance(out[-2], Intrinsic) and isinstance(out[-1], Intrinsic) and
+                [ out[-2].kind, out[-1].kind ] in STACK_NOOPS):
+            del out[-2:]
+        elif len(out) >= 2 and isinstance(out[-2], Integer) and is_intrinsic(out[-1], "pop"):
+            del out[-2:]
+        elif len(out) >= 2 and is_intrinsic(out[-2], "over") and is_intrinsic(out[-1], "over"):
+            out[-2:] = [ Fused("2dup", 0, out[-2].line_number, out[-2].file) ]
+        elif (len(out) >= 3 and is_intrinsic(out[-3], "dup") and isinstance(out[-2], Integer) and
+                is_intrinsic(out[-1], *FUSED_COMPARES)):
+            out[-3:] = [ Fused(FUSED_COMPARES[out[-1].kind], out[-2].value & 0xFF, out[-3].line_number, out[-3].file) ]
+    return out
+
+# Intrinsics that have a dedicated template when their right operand
+# is an integer literal, see Codegen.emit_const_operand
+CONST_OPERAND_OPS = [ "add", "sub", "mul", "shl", "eq", "neq", "gt", "lt" ]
+
+def decrement_ladder(count: int, flag: str) -> str:
+    # At Y with the flag cell right after it. Decrement Y up to `count`
+    # times stopping once it reaches 0. If all `count` decrements happen
+    # (Y >= count) apply `flag` to the flag cell. Y always ends at 0. The
+    # ladder itself runs min(Y, count) steps but the `[-]` clearing what
+    # is left of Y runs Y - count more, so the cost is linear in Y unless
+    # the interpreter turns `[-]` into a single op, as bfpp does
+    return "[-" * count + ">" + flag + "<[-]" + "]" * count
+
+def counting_compare(snippet: str, flag: str) -> str:
+    # Same as decrement_ladder in a size that doesn't depend on the count,
+    # at C in [ ..., Y, C, T1, T2 ] with C, T1 and T2 cleared. snippet sets
+    # C to the count, then Y and C are decremented together until Y runs
+    # out or C reaches 0, which clears Y too, so C ends at 0 only if Y >=
+    # count. The result goes to Y, 1 for that with flag "+" and 1 for the
+    # opposite with flag "-", and C is cleared. Every step checks C with
+    # T1 and T2, so it runs about 6 times the steps of the ladder
+    result = "<+>[<->[-]]" if flag == "+" else "[<+>[-]]"
+    return (snippet + "<[->-" + # Decrement Y and C
+            ">+<[>-]>[<<[-]>>->]<<" # If C is 0 clear Y, ends in C
+            "<]>" + result)
+
+def restoring_ladder(count: int, flag: str) -> str:
+    # Same as decrement_ladder but on a temporary cell T in [ ..., X, FLAG, T ]
+    # moving every decrement of T back to X, so T ends at 0 and X gets
+    # its value back
+    return "[-<<+>>" * count + "<" + flag + ">[-<<+>>]" + "]" * count
+
+# The divmod template uses up to 4 cells starting at dp as scratch
+SCRATCH_CELLS = 4
+
+# Loops of the divmod and shr templates, see Codegen.divmod_snippet and
+# LOOP_COSTS
+DIVMOD_LOOP = "[->>+<-[>>>]>[[-<+>]>+>>]<<<<<]"
+SHR_LOOP = "[->[->+<]>[-<++>]<<]"
+
+# Constant table
+#
+# For every byte value the shortest BF snippet that sets the current cell
+# to it, once by executed steps and once by code size. A snippet starts
+# and ends at the current cell, expects it and the cell after it to be 0
+# and leaves the cell after it at 0. Building the table is cheap but it is
+# still cached in build/ so every compile doesn't redo the search.
+CONST_COSTS = [ "steps", "size" ]
+CONST_TABLE_VERSION = 1
+CONST_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "bfconst-table.json")
+const_table = None
+
+def adjust_snippet(delta: int) -> str:
+    delta &= 0xFF
+    return "+" * delta if delta <= 128 else "-" * (256 - delta)
+
+def move_snippet(offset: int) -> str:
+    return ">" * offset if offset >= 0 else "<" * -offset
+
+def build_const_table() -> Dict[str, List[str]]:
+    # Candidates are plain runs of +/- (wrapping through 0 when shorter)
+    # and a multiply loop on the next cell followed by an adjustment:
+    # >(+ * a)[<(+ or - * b)>-]<(adjustment)
+    # which costs a+b+7 characters and a*(b+5)+3 steps plus the adjustment
+    loops = { "steps": {}, "size": {} }
+    for a in range(2, 65):
+        for b in range(2, 65):
+            for sign in "+-":
+                value = (a * b if sign == "+" else -a * b) & 0xFF
+                snippet = ">" + "+" * a + "[<" + sign * b + ">-]<"
+                size = a + b + 7
+                steps = a * (b + 5) + 3
+                for cost, key in (("steps", (steps, size)), ("size", (size, steps))):
+                    best = loops[cost].get(value)
+                    if best is None or key < best[0]:
+                        loops[cost][value] = (key, snippet)
+
+    table = { "version": CONST_TABLE_VERSION }
+    for cost in CONST_COSTS:
+        snippets = []
+        for n in range(256):
+            plain = adjust_snippet(n)
+            best = ((len(plain), len(plain)), plain)
+            for value, (key, snippet) in loops[cost].items():
+                adjust = adjust_snippet(n - value)
+                candidate = ((key[0] + len(adjust), key[1] + len(adjust)), snippet + adjust)
+                if candidate[0] < best[0]:
+                    best = candidate
+            snippets.append(best[1])
+        table[cost] = snippets
+    return table
+
+def load_const_table() -> Dict[str, List[str]]:
+    global const_table
+    if const_table is not None:
+        return const_table
+    try:
+        with open(CONST_TABLE_PATH, "r") as file:
+            table = json.load(file)
+        if table.get("version") == CONST_TABLE_VERSION:
+            const_table = table
+            return const_table
+    except (OSError, ValueError):
+        pass
+    const_table = build_const_table()
+    try:
+        with open(CONST_TABLE_PATH, "w") as file:
+            json.dump(const_table, file)
+    except OSError:
+        pass
+    return const_table
+
+# Arrays
+#
+# Arrays live below the stack, the most used one right below it, and grow
+# towards the start of the tape. Every element takes ARRAY_STRIDE cells
+# [ C, M, V ] (V has the highest address): the value, a lane that carries
+# a value along the array and a lane that carries the index. The first
+# ARRAY_HEADER elements are not addressable, the walk starts and ends there.
+#
+# An access with an unknown index moves the index (plus one) to the C lane
+# of the header and walks it outwards, one element per decrement, leaving
+# a 1 in the C lane of every element it leaves. Once it reaches 0 the
+# pointer is on the element. The way back follows the marks until the
+# first header element, whose C lane is never marked. A value travels in
+# the M lane next to the index or the marks, so every step is a couple of
+# fused moves for bfpp.lower and the cost scales with the index only.
+ARRAY_STRIDE = 3
+ARRAY_HEADER = 2
+ARRAY_VALUE = 0
+ARRAY_CARRY = 1
+ARRAY_INDEX = 2
+
+def count_array_ops(insts: List[Inst], counts: Dict[str, int]):
+    for inst in insts:
+        if isinstance(inst, ArrayOp):
+            counts[inst.name] = counts.get(inst.name, 0) + 1
+        elif isinstance(inst, While):
+            count_array_ops(inst.cond, counts)
+            count_array_ops(inst.body, counts)
+        elif isinstance(inst, Branch):
+            count_array_ops(inst.cond, counts)
+            count_array_ops(inst.if_body, counts)
+            count_array_ops(inst.else_body, counts)
+        elif isinstance(inst, (Block, Expansion)):
+            count_array_ops(inst.body, counts)
+
+def place_arrays(program: Program, counts: Optional[Dict[str, int]] = None):
+    if counts is None:
+        counts = {}
+        count_array_ops(program.body, counts)
+    offset = 0
+    # The last one placed ends up right below the stack
+    for name in sorted(program.arrays, key=lambda name: counts.get(name, 0)):
+        array = program.arrays[name]
+        array.offset = offset
+        offset += array.footprint()
+    program.offset = offset
+
+class Cursor(object):
+    # Builds BF that moves between cells given by their position relative
+    # to the stack, like Codegen.dp
+    def __init__(self, pos: int):
+        self.pos = pos
+        self.code = ""
+
+    def goto(self, pos: int):
+        self.code += move_snippet(pos - self.pos)
+        self.pos = pos
+
+    def emit(self, code: str):
+        self.code += code
+
+    def transfer(self, src: int, *dsts: int):
+        # Add src to every cell in dsts, src ends at 0
+        self.goto(src)
+        self.emit("[-")
+        for dst in dsts:
+            self.goto(dst)
+            self.emit("+")
+        self.goto(src)
+        self.emit("]")
+
+# BF peephole
+#
+# Runs on the code emitted by Codegen while CodeWriter writes it out. The
+# templates are joined as they are so their boundaries leave ops that undo
+# each other or work on a cell that is already 0. Every rule only deletes
+# ops, so the annotations stay on the lines they were written on:
+# - `<>`, `><`, `+-` and `-+` cancel out
+# - a loop entered on a cell that is known to be 0 never runs. That is
+#   the case at the very start of the program and right after another
+#   loop, which includes a `[-]`
+# The ops that survive so far form a stack, a new op cancels with the one
+# on top of it and a loop is checked against the op on top when it opens,
+# so a single pass from left to right leaves nothing that matches. Ops
+# below a bracket or an I/O op can't be cancelled anymore, only the run of
+# `+-<>` on top of the stack waits for what comes next, and the loops
+# are expected to be balanced, as Codegen emits them. Lines that only
+# had deleted ops on them are dropped. Dropping the `+` or `-` right
+# before a `[-]` is left to bfpp.lower, the loop would run for longer in
+# an interpreter that executes every character.
+PEEPHOLE_OPS = "+-<>[].?$!"
+PEEPHOLE_CANCEL = { "<": ">", ">": "<", "+": "-", "-": "+" }
+# Characters CodeWriter collects before writing them to its sink
+WRITE_BUFFER = 1 << 16
+
+class CodeLine(object):
+    __slots__ = ("text", "origin", "dead", "waiting", "kept")
+
+    def __init__(self, text: str, origin: tuple, kept: bool):
+        self.text = text
+        self.origin = origin
+        # Positions of the deleted ops and how many ops are still on top of
+        # the peephole stack
+        self.dead = []
+        self.waiting = 0
+        # Something on the line survives
+        self.kept = kept
+
+class CodeWriter(object):
+    # Joins the pieces of code it is given with newlines, runs the peephole
+    # pass over them as they come and writes the result to sink, a binary
+    # file, in blocks of WRITE_BUFFER characters. Without a sink the code is
+    # kept for text(). With mapped it also builds the SourceMap, every piece
+    # comes with its origin, see Codegen.
+    def __init__(self, sink = None, peephole: bool = True, at_start: bool = True, mapped: bool = True):
+        self.sink = sink
+        self.peephole = peephole
+        self.at_start = at_start
+        self.mapped = mapped
+        self.blocks = []
+        self.buffer = []
+        self.buffered = 0
+        self.out = 0
+        self.ranges = []
+        # Origin of the last line written, the newline after it is only
+        # written once another line follows
+        self.last = None
+        # The surviving op below the pending ones, the pending `+-<>` with
+        # their lines and the depth of the loop being deleted
+        self.top = None
+        self.pending = []
+        self.skip = 0
+        self.lines = []
+
+    def write(self, piece: str, origin: tuple = (0, "program", (), "")):
+        if not self.peephole:
+            self.put_line(piece, origin)
+            return
+        for text in piece.split("\n"):
+            self.feed(text, origin)
+        # Write out the lines whose ops were all settled
+        settled = 0
+        while settled < len(self.lines) and self.lines[settled].waiting == 0:
+            settled += 1
+        if settled > 0:
+            for line in self.lines[:settled]:
+                self.put(line)
+            del self.lines[:settled]
+
+    def feed(self, text: str, origin: tuple):
+        comment = text.find(";")
+        code = text if comment < 0 else text[:comment]
+        # Blank lines and the ones with a comment or anything else that isn't
+        # an op are kept whatever happens to their ops
+        line = CodeLine(text, origin, comment >= 0 or code.strip(PEEPHOLE_OPS + " \t\r") != "" or text.strip() == "")
+        self.lines.append(line)
+        pending = self.pending
+        for pos, ch in enumerate(code):
+            if ch not in PEEPHOLE_OPS:
+                continue
+            if self.skip > 0:
+                if ch == "[":
+                    self.skip += 1
+                elif ch == "]":
+                    self.skip -= 1
+                line.dead.append(pos)
+            elif ch in PEEPHOLE_CANCEL:
+                if pending and pending[-1][2] == PEEPHOLE_CANCEL[ch]:
+                    other, other_pos, _ = pending.pop()
+                    other.dead.append(other_pos)
+                    other.waiting -= 1
+                    line.dead.append(pos)
+                else:
+                    pending.append((line, pos, ch))
+                    line.waiting += 1
+            elif ch == "[" and (pending[-1][2] if pending else self.top) == "]":
+                self.skip = 1
+                line.dead.append(pos)
+            elif ch == "[" and not pending and self.top is None and self.at_start:
+                self.skip = 1
+                line.dead.append(pos)
+            else:
+                self.settle()
+                self.top = ch
+                line.kept = True
+
+    def settle(self):
+        # The pending ops survive
+        for line, _, _ in self.pending:
+            line.waiting -= 1
+            line.kept = True
+        self.pending.clear()
+
+    def put(self, line: CodeLine):
+        if not line.kept:
+            return
+        text = line.text
+        if line.dead:
+            dead = set(line.dead)
+            text = "".join(ch for pos, ch in enumerate(text) if pos not in dead)
+        self.put_line(text, line.origin)
+
+    def put_line(self, text: str, origin: tuple):
+        if self.last is not None:
+            self.emit("\n", self.last)
+        self.last = origin
+        self.emit(text, origin)
+
+    def emit(self, text: str, origin: tuple):
+        if len(text) == 0:
+            return
+        if self.mapped:
+            if self.ranges and self.ranges[-1][2:] == origin:
+                self.ranges[-1] = (self.ranges[-1][0], self.out + len(text)) + origin
+            else:
+                self.ranges.append((self.out, self.out + len(text)) + origin)
+        self.out += len(text)
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        block = "".join(self.buffer)
+        if self.sink is None:
+            self.blocks.append(block)
+        else:
+            self.sink.write(block.encode())
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self) -> SourceMap:
+        self.settle()
+        for line in self.lines:
+            self.put(line)
+        self.lines = []
+        self.flush()
+        return SourceMap(self.ranges)
+
+    def text(self) -> str:
+        return "".join(self.blocks)
+
+def op_count(code: str) -> int:
+    return sum(1 for line in code.split("\n") for ch in line.split(";", 1)[0] if ch in PEEPHOLE_OPS)
+
+def edge_ops(code: str) -> Tuple[str, str]:
+    # First and last op of code, "" if it has none
+    ops = "".join(ch for line in code.split("\n") for ch in line.split(";", 1)[0] if ch in PEEPHOLE_OPS)
+    return ops[:1], ops[-1:]
+
+def entry_ops(code: str) -> str:
+    # The ops of code that the peephole pass checks against the code before
+    # it: the ones it meets with none of the ops of code pending, up to the
+    # first one that isn't +-<>
+    entry = []
+    pending = []
+    for line in code.split("\n"):
+        for ch in line.split(";", 1)[0]:
+            if ch not in PEEPHOLE_OPS:
+                continue
+            if not pending:
+                entry.append(ch)
+            if ch not in PEEPHOLE_CANCEL:
+                return "".join(entry)
+            if pending and pending[-1] == PEEPHOLE_CANCEL[ch]:
+                pending.pop()
+            else:
+                pending.append(ch)
+    return "".join(entry)
+
+def peephole_joins(last: str, entry: str) -> bool:
+    # Whether the peephole pass changes code starting with the entry ops
+    # when it follows code ending on op last
+    return any(PEEPHOLE_CANCEL.get(last) == ch or last == "]" and ch == "[" for ch in entry)
+
+def peephole(code: str, at_start: bool = True) -> str:
+    # Without at_start the code may run on a cell that isn't 0
+    writer = CodeWriter(at_start=at_start, mapped=False)
+    writer.write(code)
+    writer.close()
+    return writer.text()
+
+# Loop unrolling
+#
+# With --unroll a while loop whose condition is known on every iteration
+# is emitted as its body repeated, as long as that stays within the code
+# size budget. Counted loops that don't fit, `while dup N lt do ... S add
+# end` and `while dup N gt do ... S sub end` from a known start, run a
+# hidden down counter in the counter cell instead of evaluating the
+# condition, when nothing in the body reads the counter.
+UNROLL_BUDGET = 2048
+STACK_EFFECTS = {
+    "pop": (1, 0), "dup": (1, 2), "over": (2, 3), "swap": (2, 2),
+    "print": (1, 0), "dbgprint": (1, 0), "divmod": (2, 2),
+    "2dup": (2, 4), "dup_lt": (1, 2), "dup_gt": (1, 2),
+}
+
+def stack_effect(insts: List[Inst]) -> Tuple[int, int]:
+    # How far below the height it starts at the code reads (as a negative
+    # number) and how many cells it leaves on the stack
+    depth = 0
+    lowest = 0
+    for inst in insts:
+        if isinstance(inst, Integer):
+            depth += 1
+        elif isinstance(inst, (Intrinsic, Fused)):
+            consumed, produced = STACK_EFFECTS.get(inst.kind, (2, 1))
+            lowest = min(lowest, depth - consumed)
+            depth += produced - consumed
+        elif isinstance(inst, ArrayOp):
+            consumed = 1 if inst.is_get else 2
+            lowest = min(lowest, depth - consumed)
+            depth += 1 - consumed
+        elif isinstance(inst, (While, Branch)):
+            # The condition leaves one more cell for the jump to consume
+            cond_lowest, cond_depth = stack_effect(inst.cond)
+            inside = depth + cond_depth - 1
+            bodies = [ inst.body ] if isinstance(inst, While) else [ inst.if_body, inst.else_body ]
+            lowest = min(lowest, depth + cond_lowest, *(inside + stack_effect(body)[0] for body in bodies))
+            depth = inside
+        elif isinstance(inst, Block):
+            lowest = min(lowest, depth + stack_effect(inst.body)[0])
+        elif isinstance(inst, Expansion):
+            body_lowest, body_depth = stack_effect(inst.body)
+            lowest = min(lowest, depth + body_lowest)
+            depth += body_depth
+    return lowest, depth
+
+def counted_loop(while_: While) -> Optional[tuple]:
+    # The bound, comparison and signed step of a counted loop
+    cond = while_.cond
+    if len(cond) == 1 and isinstance(cond[0], Fused) and cond[0].kind in FUSED_COMPARES.values():
+        compare, bound = cond[0].kind[4:], cond[0].value
+    elif (len(cond) == 3 and is_intrinsic(cond[0], "dup") and isinstance(cond[1], Integer) and
+            is_intrinsic(cond[2], "lt", "gt")):
+        compare, bound = cond[2].kind, cond[1].value & 0xFF
+    else:
+        return None
+    body = while_.body
+    if len(body) < 2 or not isinstance(body[-2], Integer) or not is_intrinsic(body[-1], "add", "sub"):
+        return None
+    step = body[-2].value & 0xFF
+    if body[-1].kind == "sub":
+        step = -step
+    if compare == "lt" and step <= 0 or compare == "gt" and step >= 0:
+        return None
+    if stack_effect(body[:-2]) != (0, 0):
+        return None
+    return bound, compare, step
+
+def trip_count(start: int, bound: int, compare: str, step: int) -> Optional[int]:
+    # None when the counter would wrap around before the loop exits
+    trips = 0
+    counter = start
+    while counter < bound if compare == "lt" else counter > bound:
+        counter += step
+        trips += 1
+    if counter < 0 or counter > 0xFF:
+        return None
+    return trips
+
+# Native intrinsics
+#
+# With --native-ops these intrinsics become a `!` call on the slots that
+# bfpp.register_bfcat_natives fills in. The slot index is pushed on top of
+# the operands and the native leaves its result in their place, so each
+# one costs a constant number of steps instead of time linear in the
+# operands. The host has to register the natives, plain BF is used without
+# the option.
+NATIVE_SLOTS = { kind: bfpp.BFCAT_NATIVE_BASE + i for i, kind in enumerate(bfpp.BFCAT_NATIVES) }
+
+# Pieces Codegen collects before it hands them to a streaming CodeWriter
+FLUSH_PIECES = 256
 
 class Codegen(object):
-    def __init__(self, program: Program):
+    # `cells` records what the emitted code left on the tape so far, keyed
+    # by position. A missing entry is a cell known to be 0, None is a cell
+    # with an unknown value. Cells past dp may hold leftovers from earlier
+    # pieces of straight-line code, each template clears the scratch cells
+    # it relies on and only when they are not already known to be 0. Loops
+    # and branches clear everything past the stack before they jump so both
+    # sides of a jump agree on the tape.
+    #
+    # `origins` records for each piece of self.result the innermost
+    # instruction that emitted it as (line, op, frames, file), frames being the
+    # while/if around it, see SourceMap. `anchors` is the dp at the pieces
+    # where an instruction starts and `reaches` the highest cell it told
+    # `cells` about, see piece_extents. All three are keyed by the index of
+    # the piece since the start, which is past self.result when the pieces
+    # are streamed to a file, see flush.
+    def __init__(self, program: Program, options: CompileOptions = None):
         self.program = program
+        self.options = options if options is not None else CompileOptions()
+        self.const_snippets = load_const_table()[self.options.const_cost]
         self.result = []
         self.dp = 0
+        self.max_dp = 0
+        self.natives = set()
+        self.cells = {}
+        self.origins = {}
+        self.anchors = {}
+        self.reaches = {}
+        self.current = 0
+        self.frames = []
+        self.source_map = None
+        # Pieces before self.result that went to the writer already, the
+        # emit_once calls still running as (start, origin) and how many
+        # callers read back what they emit
+        self.writer = None
+        self.flushed = 0
+        self.emitting = []
+        self.holds = 0
+        # Characters of the annotations left out, the unroll budget counts
+        # them all the same so that leaving them out doesn't change the code
+        self.left_out = 0
+        # What emit_expansion made of each shared macro body, by the tape
+        # it was entered with
+        self.expansions = {}
+
+    def cell(self, pos: int) -> Optional[int]:
+        return self.cells.get(pos, 0)
+
+    def reach(self, pos: int):
+        self.reaches[self.current] = max(self.reaches.get(self.current, pos), pos)
+
+    def assume(self, pos: int, value: Optional[int]):
+        self.reach(pos)
+        if value is None:
+            self.cells[pos] = None
+        elif value & 0xFF == 0:
+            self.cells.pop(pos, None)
+        else:
+            self.cells[pos] = value & 0xFF
+
+    def forget(self, upto: int):
+        # Only the cells past upto are known (to be 0) after a jump
+        self.cells = { pos: None for pos in range(upto + 1) }
+
+    def value(self, pos: int) -> Optional[int]:
+        # Known values only replace the intrinsic templates when specializing
+        return self.cell(pos) if self.options.specialize else None
+
+    def clear_snippet(self, value: Optional[int]) -> str:
+        if value == 0:
+            return ""
+        if value is not None and len(adjust_snippet(-value)) <= 3:
+            return adjust_snippet(-value)
+        return "[-]"
+
+    def zero(self, *offsets: int) -> str:
+        # BF that zeroes the cells at dp + offset for every offset, starting
+        # and ending at dp
+        code = ""
+        at = 0
+        for offset in offsets:
+            self.reach(self.dp + offset)
+            clear = self.clear_snippet(self.cell(self.dp + offset))
+            if clear == "":
+                continue
+            code += move_snippet(offset - at) + clear
+            at = offset
+            self.assume(self.dp + offset, 0)
+        return code + move_snippet(-at)
+
+    def zero_above(self, bound: int) -> str:
+        return self.zero(*sorted(pos - self.dp for pos in self.cells if pos > bound))
+
+    def emit_known_binary(self, kind: str, y: int, x: int):
+        # [ ..., Y, X ] with both values known only needs Y adjusted to the
+        # result and X cleared
+        value = FOLDABLE_BINARY[kind](y, x)
+        self.result.append("<" + self.clear_snippet(x) + "<" + adjust_snippet(value - y) + ">")
+        self.dp -= 1
+        self.assume(self.dp - 1, value)
+        self.assume(self.dp, 0)
 
     def emit_intrinsic(self, inst: Inst):
         assert isinstance(inst, Intrinsic)
+        if inst.kind in FOLDABLE_BINARY and self.dp >= 2:
+            y, x = self.value(self.dp - 2), self.value(self.dp - 1)
+            if y is not None and x is not None:
+                self.emit_known_binary(inst.kind, y, x)
+                return
+        if inst.kind == "divmod" and self.dp >= 2:
+            y, x = self.value(self.dp - 2), self.value(self.dp - 1)
+            if y is not None and x is not None:
+                quotient, remainder = divide(y, x)
+                self.result.append("<" + adjust_snippet(remainder - x) + "<" + adjust_snippet(quotient - y) + ">>")
+                self.assume(self.dp - 2, quotient)
+                self.assume(self.dp - 1, remainder)
+                return
+        if inst.kind in NATIVE_SLOTS and self.options.native_ops:
+            if self.dp < 2:
+                raise IndexError(f"Not enough elements for `{inst.kind}`")
+            self.emit_native(inst.kind, 2, 2 if inst.kind == "divmod" else 1)
+            return
         match inst.kind:
             case "pop":
                 if self.dp < 1:
                     raise IndexError("Not enough elements for `pop`")
-                self.result.append("[-]<")
+                self.result.append("<")
                 self.dp -= 1
 
             case "dup":
                 if self.dp < 1:
                     raise IndexError("Not enough elements for `dup`")
+                if self.value(self.dp - 1) is not None:
+                    self.emit_integer(self.value(self.dp - 1))
+                    return
                 self.result.append(
-                        "[-]<" # Set Y to 0 then move to X
+                        self.zero(0, 1) + "<" # Set Y and Z to 0 then move to X
                         "[->+>+<<]" # Copy X to Y and Z
                         ">>[-<<+>>]" # Move Z to X
                         )
                 self.dp += 1
+                self.assume(self.dp - 1, None)
 
             case "over":
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `over`")
+                if self.value(self.dp - 2) is not None:
+                    self.emit_integer(self.value(self.dp - 2))
+                    return
                 # [ ... X, FOO, Y, Z ]
                 self.result.append(
-                        "[-]<<" # Set Y to 0 then move to X
+                        self.zero(0, 1) + "<<" # Set Y and Z to 0 then move to X
                         "[->>+>+<<<]" # Copy X to Y and Z
                         ">>>[-<<<+>>>]" # Move Z to X
                         )
                 self.dp += 1
+                self.assume(self.dp - 1, None)
 
             case "swap":
                 # [ ... X, Y ] -> [ ... Y, X ]
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `swap`")
+                x, y = self.cell(self.dp - 2), self.cell(self.dp - 1)
+                if self.value(self.dp - 2) is not None and self.value(self.dp - 1) is not None:
+                    self.result.append("<" + adjust_snippet(x - y) + "<" + adjust_snippet(y - x) + ">>")
+                else:
+                    self.result.append(
+                            self.zero(0) +
+                            "<[->+<]"
+                            "<[->+<]"
+                            ">>[-<<+>>]")
+                self.assume(self.dp - 2, y)
+                self.assume(self.dp - 1, x)
+
+            case "add" | "sub":
+                if self.dp < 2:
+                    raise IndexError(f"Not enough elements for `{inst.kind}` expecting 2 but {self.dp} found")
+                x = self.cell(self.dp - 1)
+                sign = 1 if inst.kind == "add" else -1
+                generic = "<[-<+>]" if sign > 0 else "<[-<->]"
+                if self.value(self.dp - 1) is not None:
+                    # Apply X to Y directly instead of moving it over one by one
+                    known = "<" + self.clear_snippet(x) + "<" + adjust_snippet(sign * x) + ">"
+                    if len(known) <= len(generic):
+                        generic = known
+                self.result.append(generic)
+                self.dp -= 1
+                y = self.cell(self.dp - 1)
+                self.assume(self.dp - 1, None if y is None or x is None else y + sign * x)
+                self.assume(self.dp, 0)
+
+            case "mul":
+                # [ ..., Y, X, T, U ] => Y * X
+                if self.dp < 2:
+                    raise IndexError("Not enough elements for `mul`")
                 self.result.append(
-                        "<[->+<]"
-                        "<[->+<]"
-                        ">>[-<<+>>]")
+                        self.zero(0, 1) + "<<[->>+<<]>>" # Move Y to T
+                        "[-<[-<+>>>+<<]>>[-<<+>>]<]" # Add X to Y through U, T times
+                        "<[-]" # Clear X
+                        )
+                self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
-            case "add":
+            case "divmod" | "div" | "mod":
+                # [ ..., Y, X ] => [ ..., Y / X, Y % X ], Y / X or Y % X
+                if self.dp < 2:
+                    raise IndexError(f"Not enough elements for `{inst.kind}`")
+                self.result.append(self.zero(0, 1, 2, 3) + "<<" + self.divmod_snippet(inst.kind))
+                if inst.kind == "divmod":
+                    self.assume(self.dp - 2, None)
+                else:
+                    self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
+
+            case "shl":
+                # [ ..., Y, X, T ] => Y << X
                 if self.dp < 2:
-                    raise IndexError(f"Not enough elements for `add` expecting 2 but {self.dp} found")
-                self.result.append("<[-<+>]")
+                    raise IndexError("Not enough elements for `shl`")
+                self.result.append(
+                        self.zero(0) + "<" # Move to X
+                        "[-<[->>+<<]>>[-<<++>>]<]" # Double Y through T, X times
+                        )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
-            case "sub":
+            case "shr":
+                # [ ..., Y, X, T, U ] => Y / (1 << X)
                 if self.dp < 2:
-                    raise IndexError("Not enough elements for `sub`")
-                self.result.append("<[-<->]")
+                    raise IndexError("Not enough elements for `shr`")
+                self.result.append(
+                        self.zero(0, 1, 2, 3) + "+<" # Set T to 1 then move to X
+                        + SHR_LOOP # Double T through U, X times
+                        + ">[-<+>]<<" # Move T to X, 1 << X wraps to 0 past 7 and Y / 0 is 0
+                        + self.divmod_snippet("div"))
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
             case "print":
-                self.result.append("<. ; print")
+                self.result.append("<." + self.comment("print"))
                 self.dp -= 1
 
             case "neq":
@@ -411,24 +1629,28 @@ class Codegen(object):
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `neq`")
                 self.result.append(
-                        "[-]<" # move to X 
+                        "<" # move to X
                         "[-<->]<" # subtract Y from X, X destroyed here
                         "[[-]>+<][-]" # Check for Y if it's not 0 then set it to 1 and then move to X
                         ">[-<+>]" # Check for Y if it's not 0 then set it to 1 and then move to X
                         )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
             case "eq":
                 # [ ..., Y, X ] Y == X
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `eq`")
                 self.result.append(
-                        "[-]<" # move to X 
+                        "<" # move to X
                         "[-<->]<" # subtract Y from X, X destroyed here
                         "[[-]>+<]+" # If Y - X != 0 then set X=1. After that always set Y=1
                         ">[-<->]" # At this point X is either 1 or 0 but Y is always 1 thus Y-X will be the self.result
                         )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
             case "gt":
                 # NOTE(bagasjs): Y and X must not be 255. This is due to QUICK HACK
@@ -440,7 +1662,7 @@ class Codegen(object):
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `gt`")
                 self.result.append(
-                        "[-]>[-]>+<<<" # Clear Z and W and set A to 1 then move to X. This part ends in X
+                        self.zero(0, 1, 2) + ">>+<<<" # Clear Z, W and A, set A to 1 then move to X. This part ends in X
                         "[->+<]<[->+<]>" # Move X to Z and Move Y to X. We end in X
                         "+>+<" # QUICK HACK: Add 1 for X and Z
                         # If X > 0 decrease X then decrease Z.
@@ -450,123 +1672,589 @@ class Codegen(object):
                         "<[[-]>+<][-]>[-<+>]"
                         )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
+                self.assume(self.dp + 1, None) # Z and A are left as they are
+                self.assume(self.dp + 3, None)
 
             case "lt":
                 # NOTE(bagasjs): Y and X must not be 255. This is due to QUICK HACK
                 #                If we disable QUICK HACK it will resulting on
                 #                Weird behaviour if X or Y or both of them is 0
                 # TODO(bagasjs): Find a way to not depends on the QUICK HACK
-                if self.dp < 2:
-                    raise IndexError("Not enough elements for `lt`")
                 # [ ..., Y, X, Z, W, A ] Y > X
                 # [ ..., 21, 19, 0, 0, 1 ]
                 if self.dp < 2:
-                    raise IndexError("Not enough elements for `gt`")
+                    raise IndexError("Not enough elements for `lt`")
                 self.result.append(
-                        "[-]>[-]>+<<<" # Clear Z and W then move to X
+                        self.zero(0, 1, 2) + ">>+<<<" # Clear Z, W and A, set A to 1 then move to X
                         "[->+<]<[->+<]>" # Move X to Z and Move Y to X
                         "+>+<" # QUICK HACK: Add 1 for X and Z
                         "[->-[>]<<]>>>[-<]<" # Now we have if X > 0 then GT if Z > 0 then LT. Also we always in X
-                        "[-<<+>>]<[-]" # We need to normalize the number if Y > 0 then set Y into 1
+                        "[-<<+>>]<[-]"
                         "<[[-]>+<][-]>[-<+>]"
                         )
                 self.dp -= 1
-
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
+                self.assume(self.dp + 1, None) # Z and A are left as they are
+                self.assume(self.dp + 3, None)
 
             case "or":
-                # TODO: This wont work for `0 0 or`
                 # [ ..., Y, X ] => Y OR X
                 if self.dp < 2:
-                    raise IndexError("Not enough elements for `and`")
+                    raise IndexError("Not enough elements for `or`")
                 self.result.append(
-                        "[-]<" # Move to X,
-                        "[-<+>]<" # Add X to Y
-                        "[[-]>+<]>" # Set Y to 0 and X to 1 if Y > 0 
+                        "<" # Move to X
+                        "[[-]<[-]+>]<" # If X != 0 set X to 0 and Y to 1
+                        "[[-]>+<]>" # Set Y to 0 and X to 1 if Y > 0
                         "[-<+>]"
                         )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, 0)
 
             case "and":
                 # [ ..., Y, X, Z ] => Y AND X
                 if self.dp < 2:
                     raise IndexError("Not enough elements for `and`")
                 self.result.append(
-                        "[-]<<" # Move to X
+                        self.zero(0) + "<<" # Move to X
                         "[[-]>[[-]>+<]<]" # If X != 0 set X to 0 if Y != 0 set Y to 0 and set Z = 1
                         ">>[-<<+>>]<" # Move the value of Z to Y
                         )
                 self.dp -= 1
+                self.assume(self.dp - 1, None)
+                self.assume(self.dp, None)
 
             # Helper intrinsic
             case "dbgprint":
-                self.result.append("<? ; dbgprint")
+                self.result.append("<?" + self.comment("dbgprint"))
                 self.dp -= 1
 
 
+    def divmod_snippet(self, kind: str) -> str:
+        # Starts at Y in [ ..., Y, X, 0, 0, 0, 0 ] and ends at the new dp.
+        # One pass over Y: X counts down while R counts up and every time X
+        # reaches 0 it is refilled from R and Q goes up
+        # [ ..., Y, X, R, Q, 0, 0 ] => [ ..., 0, X - Y % X, Y % X, Y / X, 0, 0 ]
+        code = DIVMOD_LOOP
+        if kind == "divmod":
+            return code + ">[-]>>[-<<<+>>>]<[-<+>]"
+        if kind == "div":
+            return code + ">[-]>[-]>[-<<<+>>>]<<"
+        return code + ">[-]>[-<<+>>]>[-]<<"
+
+    def emit_native(self, kind: str, consumed: int, produced: int):
+        # [ ..., ARGS(consumed) ] => [ ..., RESULTS(produced) ] by calling
+        # the native reserved for kind with its slot index on top
+        slot = NATIVE_SLOTS[kind]
+        self.natives.add(slot)
+        self.emit_integer(slot)
+        self.dp -= 1
+        end = self.dp - consumed + produced
+        self.result.append("<!" + move_snippet(end - self.dp))
+        for pos in range(self.dp - consumed, self.dp + 1):
+            self.assume(pos, None if pos < end else 0)
+        self.dp = end
+
+    def emit_fused(self, fused: Fused):
+        match fused.kind:
+            case "2dup":
+                # [ ..., A, B ] => [ ..., A, B, A, B ]
+                if self.dp < 2:
+                    raise IndexError("Not enough elements for `over over`")
+                if self.value(self.dp - 2) is not None or self.value(self.dp - 1) is not None:
+                    self.emit_intrinsic(Intrinsic("over"))
+                    self.emit_intrinsic(Intrinsic("over"))
+                    return
+                self.result.append(
+                        self.zero(0, 1, 2) + "<<" # Move to A
+                        "[->>+>>+<<<<]>>>>[-<<<<+>>>>]" # Copy A past B and back through T
+                        "<<<[->>+>+<<<]>>>[-<<<+>>>]" # Copy B past the copy of A and back through T
+                        )
+                self.dp += 2
+                self.assume(self.dp - 2, None)
+                self.assume(self.dp - 1, None)
+
+            case "dup_lt" | "dup_gt":
+                # [ ..., X ] => [ ..., X, X < value ] or [ ..., X, X > value ]
+                if self.dp < 1:
+                    raise IndexError(f"Not enough elements for `dup {fused.value} {fused.kind[4:]}`")
+                x = self.value(self.dp - 1)
+                if x is not None:
+                    self.emit_integer(FOLDABLE_BINARY[fused.kind[4:]](x, fused.value))
+                    return
+                count = self.ladder_count(fused)
+                if count is None:
+                    self.emit_insts([ Intrinsic("dup"), Integer(fused.value), Intrinsic(fused.kind[4:]) ])
+                    return
+                if count == 0 or count > 0xFF:
+                    # X < 0 and X > 255
+                    self.emit_integer(0)
+                    return
+                code = self.zero(0, 1) + "<[->>+<<]>" # Move X to T and stop at FLAG
+                if fused.kind == "dup_lt":
+                    # X < value is not X >= value
+                    code += "+>" + restoring_ladder(count, "-")
+                else:
+                    # X > value is X >= value + 1
+                    code += ">" + restoring_ladder(count, "+")
+                self.result.append(code)
+                self.dp += 1
+                self.assume(self.dp - 2, None)
+                self.assume(self.dp - 1, None)
+
+    def ladder_count(self, fused: Fused) -> Optional[int]:
+        # The K of the X >= K that the restoring ladder of a dup_lt or dup_gt
+        # tests, None when the generic templates are used instead
+        if self.options.const_cost == "size" or self.options.native_ops:
+            # A restoring ladder is about 3 times larger than the one in
+            # emit_const_operand, and slower than a native comparison
+            return None
+        return fused.value if fused.kind == "dup_lt" else fused.value + 1
+
+    def emit_const_operand(self, kind: str, value: int):
+        # [ ..., Y ] followed by `value kind` computes Y kind value in place
+        # instead of pushing value and running the generic template
+        if self.dp < 1:
+            raise IndexError(f"Not enough elements for `{kind}`")
+        y = self.cell(self.dp - 1)
+        if y is not None:
+            result = FOLDABLE_BINARY[kind](y, value)
+            self.result.append("<" + adjust_snippet(result - y) + ">")
+            self.assume(self.dp - 1, result)
+            return
+        match kind:
+            case "add":
+                self.result.append("<" + adjust_snippet(value) + ">")
+            case "mul" | "shl":
+                # Y * 2 ** value for shl, which is 0 past 7
+                factor = value if kind == "mul" else (1 << value) & 0xFF
+                if factor == 0:
+                    self.result.append("<[-]>")
+                elif factor != 1:
+                    self.result.append(self.zero(0) + "<[->+<]>[-<" + adjust_snippet(factor) + ">]")
+            case "sub":
+                self.result.append("<" + adjust_snippet(-value) + ">")
+            case "eq":
+                self.result.append(
+                        self.zero(0) + "<" + adjust_snippet(-value) + # Y - value is 0 only if they are equal
+                        "[[-]>+<]+>[-<->]" # Same as the end of `eq`
+                        )
+            case "neq":
+                self.result.append(
+                        self.zero(0) + "<" + adjust_snippet(-value) +
+                        "[[-]>+<]>[-<+>]" # Same as the end of `neq`
+                        )
+            case "gt":
+                # Y > value is Y >= value + 1
+                if value == 0xFF:
+                    self.result.append("<[-]>")
+                else:
+                    self.result.append(self.compare_at_least(value + 1, "+"))
+            case "lt":
+                # Y < value is not Y >= value
+                if value == 0:
+                    self.result.append("<[-]>")
+                else:
+                    self.result.append(self.compare_at_least(value, "-"))
+        self.assume(self.dp - 1, None)
+
+    def compare_at_least(self, count: int, flag: str) -> str:
+        # [ ..., Y ] => [ ..., Y >= count ] with flag "+" or [ ..., Y < count ]
+        # with flag "-". The ladder is 2 characters per count, with
+        # --const-cost size the counting loop is taken once it is shorter
+        ladder = "<" + decrement_ladder(count, flag) + ">[-<+>]"
+        counting = counting_compare(self.const_snippets[count], flag)
+        if self.options.const_cost == "size" and len(counting) < len(ladder):
+            return self.zero(0, 1, 2) + counting
+        return self.zero(0) + ("+" if flag == "-" else "") + ladder
+
+    def emit_insts(self, insts: List[Inst]):
+        i = 0
+        while i < len(insts):
+            inst = insts[i]
+            if (self.options.specialize and isinstance(inst, Integer) and i + 1 < len(insts) and
+                    isinstance(insts[i + 1], Intrinsic) and insts[i + 1].kind in CONST_OPERAND_OPS and
+                    not (self.options.native_ops and insts[i + 1].kind in NATIVE_SLOTS)):
+                start = self.position()
+                self.anchors.setdefault(start, self.dp)
+                outer, self.current = self.current, start
+                origin = (insts[i + 1].line_number, f"{inst.value} {insts[i + 1].kind}", tuple(self.frames), insts[i + 1].file)
+                self.emitting.append((start, origin))
+                self.emit_const_operand(insts[i + 1].kind, inst.value & 0xFF)
+                self.emitting.pop()
+                self.current = outer
+                self.note_origin(start, origin)
+                self.max_dp = max(self.max_dp, self.dp)
+                self.flush()
+                i += 2
+                continue
+            self.emit_once(inst)
+            i += 1
+
+    def snapshot(self) -> tuple:
+        return self.position(), self.dp, self.max_dp, set(self.natives), dict(self.cells), self.left_out
+
+    def rollback(self, snapshot: tuple):
+        length, self.dp, self.max_dp, self.natives, self.cells, self.left_out = snapshot
+        for index in range(length, self.position() + 1):
+            self.origins.pop(index, None)
+            self.anchors.pop(index, None)
+            self.reaches.pop(index, None)
+        del self.result[length - self.flushed:]
+
+    def unroll_while(self, while_: While) -> bool:
+        # Emit the body for as long as the condition is known, or nothing at
+        # all if it isn't known every time or the code grows past the budget
+        snapshot = self.snapshot()
+        start_sp = self.dp
+        self.holds += 1
+        try:
+            self.annotate("Unrolled loop")
+            while True:
+                self.emit_insts(while_.cond)
+                cond = self.value(self.dp - 1)
+                size = sum(len(code) for code in self.result[snapshot[0] - self.flushed:]) + self.left_out - snapshot[5]
+                if cond is None or size > self.options.unroll_budget:
+                    self.rollback(snapshot)
+                    return False
+                self.result.append("<")
+                self.dp -= 1
+                if cond == 0:
+                    return True
+                self.emit_insts(while_.body)
+                if self.dp != start_sp:
+                    error(f"While loop at line {source_location(while_.line_number, while_.file)} starts with SP={start_sp} but ends with SP={self.dp}")
+        finally:
+            self.holds -= 1
+
+    def emit_counted_while(self, while_: While) -> bool:
+        # [ ..., COUNTER ] counts the trips left down to 0 while the body
+        # runs and ends up at the value the loop exits with
+        counted = counted_loop(while_)
+        start = self.value(self.dp - 1) if self.dp >= 1 else None
+        if counted is None or start is None:
+            return False
+        bound, compare, step = counted
+        trips = trip_count(start, bound, compare, step)
+        if trips is None:
+            return False
+        start_sp = self.dp
+        self.annotate("Counted loop")
+        self.result.append(self.zero_above(self.dp - 1) + "<" + adjust_snippet(trips - start) + "[>")
+        self.forget(self.dp - 1)
+        self.emit_insts(while_.body[:-2])
+        if self.dp != start_sp:
+            error(f"While loop at line {source_location(while_.line_number, while_.file)} starts with SP={start_sp} but ends with SP={self.dp}")
+        self.result.append(self.zero_above(self.dp - 1) + "<-]" + adjust_snippet(start + trips * step) + ">")
+        self.forget(self.dp - 2)
+        self.assume(self.dp - 1, start + trips * step)
+        return True
+
     def emit_while(self, while_: Inst):
         assert isinstance(while_, While)
+        if self.options.unroll and (self.unroll_while(while_) or self.emit_counted_while(while_)):
+            return
         start_sp = self.dp;
-        self.result.append(";; Preamble condition")
-        for inst in while_.cond:
-            self.emit_once(inst)
-        self.result.append(";; Start of the loop")
-        self.result.append("<[")
+        self.annotate("Preamble condition")
+        self.emit_insts(while_.cond)
+        self.annotate("Start of the loop")
+        self.result.append(self.zero_above(self.dp - 1) + "<[")
         self.dp -= 1
-        self.result.append(";; Loop Body")
-        for inst in while_.body:
-            self.emit_once(inst)
-        self.result.append(";; Loop Condition Checking")
-        for inst in while_.cond:
-            self.emit_once(inst)
-        self.result.append("<]")
+        if len(while_.cond) > 0 and is_compare(while_.cond[-1]):
+            # Both conditions leave 0 or 1, so the body starts on a 1
+            self.forget(self.dp - 1)
+            self.assume(self.dp, 1)
+        else:
+            self.forget(self.dp)
+        self.annotate("Loop Body")
+        self.emit_insts(while_.body)
+        self.annotate("Loop Condition Checking")
+        self.emit_insts(while_.cond)
+        self.result.append(self.zero_above(self.dp - 1) + "<]")
         self.dp -= 1
         if self.dp != start_sp:
-            error(f"While loop at line {while_.line_number} starts with SP={start_sp} but ends with SP={self.dp}")
+            error(f"While loop at line {source_location(while_.line_number, while_.file)} starts with SP={start_sp} but ends with SP={self.dp}")
+        # The loop only exits once the condition is 0
+        self.forget(self.dp - 1)
 
     def emit_branch(self, branch: Inst):
         assert isinstance(branch, Branch)
-        start_sp = self.dp
-        self.result.append(";; Check for condition")
-        for inst in branch.cond:
-            self.emit_once(inst)
-        # [ ... CONDITION_RESULT, A ]
-        self.result.append(";; IF condition")
-        self.result.append("[-]+<[") # If CONDITION_RESULT 
-        self.result.append("[-]>[-]>")
-        for inst in branch.if_body:
-            self.emit_once(inst)
+        self.annotate("Check for condition")
+        if len(branch.cond) > 0 and is_compare(branch.cond[-1]):
+            self.emit_insts(branch.cond[:-1])
+            if self.emit_compare_branch(branch, branch.cond[-1]):
+                return
+            self.emit_insts(branch.cond[-1:])
+        else:
+            self.emit_insts(branch.cond)
+        # The condition is consumed and the bodies run past it
+        end_sp = self.dp - 1
+        self.annotate("IF condition")
+        if len(branch.else_body) > 0:
+            # [ ... CONDITION_RESULT, A ]
+            self.result.append(self.zero_above(end_sp) + "+<[") # If CONDITION_RESULT
+            self.result.append("[-]>[-]>")
+        else:
+            # Without an else there is no need for the A flag
+            self.result.append(self.zero_above(end_sp) + "<[[-]>>") # If CONDITION_RESULT
+        self.emit_body(branch.if_body, end_sp, f"If body at line {source_location(branch.line_number, branch.file)}")
         self.result.append("<<]") # End of If
         if len(branch.else_body) > 0:
-            self.result.append(";; ELSE")
+            self.annotate("ELSE")
             self.result.append(">[[-]>") # Start of else
-            for inst in branch.else_body:
-                self.emit_once(inst)
+            self.emit_body(branch.else_body, end_sp, f"Else body at line {source_location(branch.line_number, branch.file)}")
             self.result.append("<]<") # End of else
+        self.dp = end_sp
+        self.forget(end_sp - 1)
+        self.annotate("ENDIF")
+
+    def emit_compare_branch(self, branch: Branch, compare: Fused) -> bool:
+        # An if on `dup N lt` or `dup N gt` branches inside the restoring
+        # ladder of the comparison. The body for X >= K runs where the
+        # ladder made all K decrements and the other one on a flag that is
+        # only set when that body isn't empty, so there is no 0/1 result
+        # to branch on afterwards.
+        # [ ..., X, FLAG, T ] with X moved to T
+        count = self.ladder_count(compare)
+        if count is None or self.dp < 1 or self.value(self.dp - 1) is not None or count == 0 or count > 0xFF:
+            return False
+        if_what = f"If body at line {source_location(branch.line_number, branch.file)}"
+        else_what = f"Else body at line {source_location(branch.line_number, branch.file)}"
+        if compare.kind == "dup_lt":
+            (above, above_what), (below, below_what) = (branch.else_body, else_what), (branch.if_body, if_what)
         else:
-            self.dp -= 1
-        self.result.append(";; ENDIF")
-        if self.dp != start_sp:
-            error(f"If statement at line {branch.line_number} starts with SP={start_sp} but ends with SP={self.dp}")
+            (above, above_what), (below, below_what) = (branch.if_body, if_what), (branch.else_body, else_what)
+        end_sp = self.dp
+        flag = "+" if len(below) > 0 else ""
+        self.annotate("IF comparison")
+        self.result.append(self.zero(0, 1) + "<[->>+<<]>" + flag + ">" + "[-<<+>>" * count + # Move X to T and count it down
+                           "<" + flag.replace("+", "-") + ">[-<<+>>]") # X >= K, give the rest of T back to X
+        if len(above) > 0:
+            self.result.append(">")
+            self.emit_body(above, end_sp, above_what)
+            self.result.append("<")
+        self.result.append("]" * count + "<")
+        if len(below) > 0:
+            self.annotate("Below the count")
+            self.result.append("[->>")
+            self.emit_body(below, end_sp, below_what)
+            self.result.append("<<]")
+        self.dp = end_sp
+        self.forget(end_sp - 1)
+        self.annotate("ENDIF")
+        return True
+
+    def emit_body(self, body: List[Inst], end_sp: int, what: str):
+        # Run a branch body two cells past end_sp and clear what it leaves there
+        self.dp = end_sp + 2
+        self.forget(end_sp - 1)
+        self.emit_insts(body)
+        if self.dp != end_sp + 2:
+            error(f"{what} starts with SP={end_sp} but ends with SP={self.dp - 2}")
+        self.result.append(self.zero_above(end_sp + 1))
+
+    def emit_block(self, block: Block):
+        # Same layout as a taken if but nothing jumps so the tape state
+        # carries over
+        self.annotate("Known condition")
+        self.result.append(">>")
+        end_sp = self.dp
+        self.dp += 2
+        self.emit_insts(block.body)
+        if self.dp != end_sp + 2:
+            error(f"If body at line {source_location(block.line_number, block.file)} starts with SP={end_sp} but ends with SP={self.dp - 2}")
+        self.result.append("<<")
+        self.dp = end_sp
+
+    def emit_expansion(self, expansion: Expansion):
+        # The BF of a shared macro body only depends on dp and `cells`, so
+        # it is emitted once for each of those it is entered with and then
+        # copied, along with what it records for the source map and report
+        start = self.position()
+        key = (id(expansion.body), self.dp, tuple(sorted(self.cells.items())))
+        emitted = self.expansions.get(key)
+        if emitted is None:
+            depth = len(self.frames)
+            max_dp, natives, left_out = self.max_dp, set(self.natives), self.left_out
+            self.max_dp = self.dp
+            self.holds += 1
+            self.emit_insts(expansion.body)
+            self.holds -= 1
+            end = self.position()
+            emitted = (expansion.body, self.result[start - self.flushed:end - self.flushed], self.dp, dict(self.cells), self.max_dp,
+                       self.natives - natives,
+                       [ (index - start,) + self.origins[index][:2] + (self.origins[index][2][depth:],) + self.origins[index][3:]
+                         for index in range(start, end) if index in self.origins ],
+                       [ (index - start, self.anchors[index]) for index in range(start, end) if index in self.anchors ],
+                       [ (index - start, self.reaches[index]) for index in range(start, end) if index in self.reaches ],
+                       self.left_out - left_out)
+            self.expansions[key] = emitted
+            self.max_dp = max(self.max_dp, max_dp)
+            return
+        _, pieces, self.dp, cells, max_dp, natives, origins, anchors, reaches, left_out = emitted
+        self.result.extend(pieces)
+        self.left_out += left_out
+        self.cells = dict(cells)
+        self.max_dp = max(self.max_dp, max_dp)
+        self.natives |= natives
+        frames = tuple(self.frames)
+        for index, line_number, op, inner, file in origins:
+            self.origins.setdefault(start + index, (line_number, op, frames + inner, file))
+        for index, dp in anchors:
+            self.anchors.setdefault(start + index, dp)
+        for index, pos in reaches:
+            self.reaches[start + index] = max(self.reaches.get(start + index, pos), pos)
+
+    def array_cell(self, array: ArraySpec, index: int, lane: int) -> int:
+        top = array.offset + array.footprint() - 1 - self.program.offset
+        return top - (index + ARRAY_HEADER) * ARRAY_STRIDE - lane
 
     def emit_array_op(self, inst: ArrayOp):
+        if inst.name not in self.program.arrays:
+            error(f"Unknown array {inst.name}")
         array = self.program.arrays[inst.name]
-        if inst.is_get:
+        index_at = self.dp - 1 if inst.is_get else self.dp - 2
+        if index_at < 0:
+            raise IndexError(f"Not enough elements for `{inst}`")
+        index = self.value(index_at)
+        if index is not None and index >= array.size:
+            error(f"Index {index} is out of bounds for array {inst.name} of size {array.size}")
+        if index is None and self.options.native_ops:
+            # The native gets the address of the first element past the operands
+            self.annotate(str(inst))
+            address = self.program.offset + self.array_cell(array, 0, ARRAY_VALUE)
+            self.emit_integer(address >> 8)
+            self.emit_integer(address & 0xFF)
+            if inst.is_get:
+                self.emit_native("array_get", 3, 1)
+            else:
+                self.emit_native("array_set", 4, 0)
+            return
+        cursor = Cursor(self.dp)
+        if inst.is_get and index is not None:
             # Get Consume 1 DP which is [ ..., index ]
-            print(f"Getting {inst.name} {array}")
-            self.result.append(";; array_get")
-            goto_array_start = "<" * self.dp + ">" * array.offset 
-            from_start_to_curr = 
-            self.result.append()
+            # Copy the element through its M lane
+            value = self.array_cell(array, index, ARRAY_VALUE)
+            carry = self.array_cell(array, index, ARRAY_CARRY)
+            cursor.goto(index_at)
+            cursor.emit(self.clear_snippet(index))
+            cursor.transfer(value, index_at, carry)
+            cursor.transfer(carry, value)
+        elif inst.is_get:
+            cursor.transfer(index_at, self.array_cell(array, -1, ARRAY_INDEX))
+            cursor.goto(self.array_cell(array, -1, ARRAY_INDEX))
+            cursor.emit(
+                    "+[-[-<<<+>>>]+<<<]" # Walk the index to the element
+                    ">>[-<+<+>>]<<[->>+<<]" # Copy V to M through C
+                    ">>>[-<<[->>>+<<<]>>>>>]" # Bring M back following the marks
+                    )
+            cursor.pos = self.array_cell(array, -2, ARRAY_INDEX)
+            cursor.transfer(self.array_cell(array, -1, ARRAY_CARRY), index_at)
+        elif index is not None:
+            # Set consume 2 DP which is [ ... index, value ]
+            value = self.array_cell(array, index, ARRAY_VALUE)
+            cursor.goto(value)
+            cursor.emit("[-]")
+            cursor.transfer(self.dp - 1, value)
+            cursor.goto(index_at)
+            cursor.emit(self.clear_snippet(index))
+        else:
+            cursor.transfer(index_at, self.array_cell(array, -1, ARRAY_INDEX))
+            cursor.transfer(self.dp - 1, self.array_cell(array, -1, ARRAY_CARRY))
+            cursor.goto(self.array_cell(array, -1, ARRAY_INDEX))
+            cursor.emit(
+                    "+[-[-<<<+>>>]>[-<<<+>>>]<+<<<]" # Walk the index and the value to the element
+                    ">>[-]<[->+<]<" # Move M to V
+                    ">>>[->>>]" # Follow the marks back
+                    )
+            cursor.pos = self.array_cell(array, -2, ARRAY_INDEX)
+        if inst.is_get:
+            cursor.goto(self.dp)
+            self.assume(index_at, None)
         else:
-            # Set consume 2 DP which is [ ... index, value ] 
-            print(f"Setting {inst.name} {array}")
-            self.result.append(";; array_set")
+            cursor.goto(index_at)
+            self.assume(self.dp - 1, 0)
+            self.assume(self.dp - 2, 0)
             self.dp -= 2
+        self.annotate(str(inst))
+        self.result.append(cursor.code)
+
+    def emit_integer(self, value: int):
+        value &= 0xFF
+        current = self.cell(self.dp)
+        snippet = self.const_snippets[value]
+        code = self.clear_snippet(current) + snippet
+        if current is not None and len(adjust_snippet(value - current)) <= len(code):
+            # Cheaper to adjust whatever is known to be there already
+            code = adjust_snippet(value - current)
+        elif snippet.startswith(">"):
+            # The multiply loop counts on the next cell
+            code = self.zero(1) + code
+        self.result.append(code + "> ")
+        self.assume(self.dp, value)
+        self.dp += 1
+
+    def note_origin(self, start: int, origin: tuple):
+        # Claim the pieces emitted since start that nothing nested claimed,
+        # flush claimed the ones it wrote already
+        for index in range(max(start, self.flushed), self.position()):
+            self.origins.setdefault(index, origin)
+
+    def position(self) -> int:
+        # Index of the next piece
+        return self.flushed + len(self.result)
+
+    def annotate(self, text: str):
+        if self.options.annotate:
+            self.result.append(f";; {text}")
+        else:
+            self.left_out += len(text) + 3
+
+    def comment(self, text: str) -> str:
+        # A comment at the end of a piece
+        if self.options.annotate:
+            return f" ; {text}"
+        self.left_out += len(text) + 3
+        return ""
+
+    def flush(self, final: bool = False):
+        # Hand the pieces to the writer. While streaming that happens every
+        # FLUSH_PIECES pieces unless something may still take them back,
+        # the pieces nothing claimed yet belong to the innermost emit_once
+        # that started before them
+        if self.writer is None:
+            return
+        streaming = self.writer.sink is not None
+        if not final and (not streaming or self.holds > 0 or len(self.result) < FLUSH_PIECES):
+            return
+        for index, piece in enumerate(self.result, self.flushed):
+            origin = self.origins.get(index)
+            if origin is None:
+                origin = next((origin for start, origin in reversed(self.emitting) if start <= index), (0, "program", (), ""))
+            self.writer.write(piece, origin)
+        if streaming:
+            end = self.position()
+            for index in range(self.flushed, end):
+                self.origins.pop(index, None)
+                self.anchors.pop(index, None)
+                self.reaches.pop(index, None)
+            self.result = []
+            self.flushed = end
 
     def emit_once(self, inst: Inst):
+        frame = frame_name(inst)
+        if frame is not None:
+            self.frames.append(frame)
+        start = self.position()
+        self.anchors.setdefault(start, self.dp)
+        outer, self.current = self.current, start
+        origin = (inst.line_number, op_name(inst), tuple(self.frames), inst.file)
+        self.emitting.append((start, origin))
         if isinstance(inst, Integer):
-            self.result.append("[-]" + "+" * inst.value+ f"> ")
-            self.dp += 1
+            self.emit_integer(inst.value)
         elif isinstance(inst, Intrinsic):
             self.emit_intrinsic(inst)
         elif isinstance(inst, While):
@@ -575,41 +2263,997 @@ class Codegen(object):
             self.emit_array_op(inst)
         elif isinstance(inst, Branch):
             self.emit_branch(inst)
-
-    def emit_all(self):
+        elif isinstance(inst, Block):
+            self.emit_block(inst)
+        elif isinstance(inst, Fused):
+            self.emit_fused(inst)
+        elif isinstance(inst, Expansion):
+            self.emit_expansion(inst)
+        self.emitting.pop()
+        self.current = outer
+        self.note_origin(start, origin)
+        if frame is not None:
+            self.frames.pop()
+        self.max_dp = max(self.max_dp, self.dp)
+        self.flush()
+
+    def tape_size(self) -> int:
+        return self.program.offset + self.max_dp + SCRATCH_CELLS
+
+    def emit_all(self, sink = None, mapped: bool = True) -> Optional[str]:
+        # Writes the code to sink, a binary file, as it is emitted, or returns
+        # it without one. Only without a sink self.result keeps every piece
+        # for the report
+        self.writer = CodeWriter(sink, self.options.peephole, mapped=mapped)
         if self.program.offset > 0:
             print("Program offset: ", self.program.offset)
-            self.result.append(";; Aggregate Array Offset")
+            self.annotate("Aggregate Array Offset")
             self.result.append(">" * self.program.offset + "\n")
-        for inst in self.program.body:
-            self.emit_once(inst)
-        return "\n".join(self.result)
-
-def compile_to_brainfuck(source: str, debug_sym: bool = False) -> str:
+        self.emit_insts(self.program.body)
+        self.flush(True)
+        self.source_map = self.writer.close()
+        return self.writer.text() if sink is None else None
+
+def source_location(line_number: int, file: str) -> str:
+    # A line of the file being compiled is just its number
+    return f"{os.path.relpath(file)}:{line_number}" if file else str(line_number)
+
+def frame_name(inst: Inst) -> Optional[str]:
+    if isinstance(inst, While):
+        return f"while@{source_location(inst.line_number, inst.file)}"
+    if isinstance(inst, (Branch, Block)):
+        return f"if@{source_location(inst.line_number, inst.file)}"
+    return None
+
+def op_name(inst: Inst) -> str:
+    if isinstance(inst, Integer):
+        return str(inst.value)
+    if isinstance(inst, Fused):
+        if inst.kind == "2dup":
+            return "over over"
+        if inst.kind in FUSED_COMPARES.values():
+            return f"dup {inst.value} {inst.kind[len('dup_'):]}"
+        return inst.kind
+    if isinstance(inst, While):
+        return "while"
+    if isinstance(inst, (Branch, Block)):
+        return "if"
+    if isinstance(inst, Expansion):
+        return inst.macro.name
+    return repr(inst)
+
+class SourceMap(object):
+    # Maps ranges of the emitted BF back to the source. Every range is
+    # (start, end, line, op, frames, file), end excluded, with frames the
+    # while and if around the op from the outermost in and file the loaded
+    # module the line is in or "" for the file itself. Line 0 is code that
+    # the compiler made up such as the array offset.
+    def __init__(self, ranges: List[tuple], file: str = ""):
+        self.ranges = ranges
+        self.file = file
+        self.starts = [ item[0] for item in ranges ]
+
+    def lookup(self, pos: int) -> Optional[tuple]:
+        index = bisect.bisect_right(self.starts, pos) - 1
+        if index < 0 or pos >= self.ranges[index][1]:
+            return None
+        return self.ranges[index]
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump({ "file": self.file, "ranges": [ list(item[:4]) + [ list(item[4]), item[5] ] for item in self.ranges ] }, file)
+
+    @staticmethod
+    def load(path: str) -> SourceMap:
+        with open(path, "r") as file:
+            data = json.load(file)
+        return SourceMap([ tuple(item[:4]) + (tuple(item[4]), item[5]) for item in data["ranges"] ], data["file"])
+
+OUTPUT_FORMATS = [ "bf", "bfb" ]
+TARGETS = [ "bfpp", "c" ]
+
+class CompileOptions(object):
+    def __init__(self, format: str = "bf", target: str = "bfpp", const_cost: str = "steps",
+                 fold: bool = True, specialize: bool = True, peephole: bool = True,
+                 fuse: bool = True, native_ops: bool = False, unroll: bool = False,
+                 unroll_budget: int = UNROLL_BUDGET, annotate: bool = True):
+        self.format = format
+        self.target = target
+        self.const_cost = const_cost
+        self.fold = fold
+        self.specialize = specialize
+        self.peephole = peephole
+        self.fuse = fuse
+        self.native_ops = native_ops
+        self.unroll = unroll
+        self.unroll_budget = unroll_budget
+        # Emit the `;;` comments that tell which template is which
+        self.annotate = annotate
+
+def parse_program(source: str, path: str = None) -> Program:
+    # path is where the source comes from, if it is a file, for `load`
     tokens = parse_tokens(source)
-    parser = Parser(tokens)
+    if path is None:
+        parser = Parser(tokens)
+    else:
+        parser = Parser(tokens, os.path.dirname(path), (os.path.abspath(path),))
     parser.parse()
-    codegen = Codegen(parser.program)
+    return parser.program
+
+def make_codegen(source: str, options: CompileOptions, path: str = None) -> Codegen:
+    program = parse_program(source, path)
+    if options.fold:
+        program.body = fold_constants(program.body)
+    if options.fuse:
+        program.body = fuse_stack_ops(program.body)
+    place_arrays(program)
+    return Codegen(program, options)
+
+def compile_to_brainfuck(source: str, options: CompileOptions = CompileOptions(), path: str = None) -> str:
+    codegen = make_codegen(source, options, path)
     return codegen.emit_all()
 
-def compile_file(input_file, output_file):
+def compile_with_source_map(source: str, file: str, options: CompileOptions = CompileOptions()) -> Tuple[str, SourceMap]:
+    codegen = make_codegen(source, options, file)
+    result = codegen.emit_all()
+    codegen.source_map.file = file
+    return result, codegen.source_map
+
+# Compile cache
+#
+# compile_file keeps what it writes in COMPILE_CACHE_DIR under a hash of
+# the source, the options, the source of the compiler itself (this file
+# and bfpp.py) and the keys of the modules it loads, so a hit is exactly
+# what compiling again would give and is copied out without parsing.
+# Every hit touches its entry and once the cache grows past
+# COMPILE_CACHE_LIMIT bytes the least recently used entries are removed.
+COMPILE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "bfcat-cache")
+COMPILE_CACHE_LIMIT = 64 * 1024 * 1024
+compiler_digest = None
+
+def compiler_hash() -> str:
+    global compiler_digest
+    if compiler_digest is None:
+        digest = hashlib.sha256()
+        for module in (__file__, bfpp.__file__):
+            with open(module, "rb") as file:
+                digest.update(file.read())
+        compiler_digest = digest.hexdigest()
+    return compiler_digest
+
+def source_loads(source: str, path: str) -> List[Tuple[str, str]]:
+    # (path, key) of the modules source loads, also through other modules
+    if "load" not in source:
+        return []
+    tokens = parse_tokens(source)
+    loads = []
+    for i in range(len(tokens) - 1):
+        if tokens.kinds[i] == TOK_LOAD and tokens.kinds[i + 1] == TOK_STRING:
+            module = load_module(os.path.join(os.path.dirname(path), tokens.texts[i + 1]),
+                                 (os.path.abspath(path),), tokens.lines[i])
+            loads.append((module.path, module.key))
+            loads.extend(module.deps)
+    return loads
+
+def compile_cache_key(source: str, options: CompileOptions, loads: List[Tuple[str, str]] = ()) -> str:
+    key = hashlib.sha256(compiler_hash().encode())
+    key.update(json.dumps(vars(options), sort_keys=True).encode())
+    key.update(json.dumps(sorted(set(loads))).encode())
+    key.update(source.encode())
+    return key.hexdigest()
+
+def cache_load(key: str) -> Optional[str]:
+    # Path of the entry, if there is one
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    try:
+        os.utime(path)
+        return path
+    except OSError:
+        return None
+
+def cache_store(key: str, output_file: str):
+    # Copied aside and renamed so that a compile running at the same time
+    # never reads half an entry
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    try:
+        os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(output_file, temp)
+        os.replace(temp, path)
+        cache_evict(COMPILE_CACHE_LIMIT)
+    except OSError:
+        pass
+
+def cache_evict(limit: int):
+    entries = []
+    for name in os.listdir(COMPILE_CACHE_DIR):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(COMPILE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def write_output(output_file: str, data: bytes, binary: bool):
+    if binary:
+        with open(output_file, "wb") as ofile:
+            ofile.write(data)
+    else:
+        with open(output_file, "w") as ofile:
+            ofile.write(data.decode())
+
+def compile_file(input_file, output_file, options: CompileOptions = CompileOptions(),
+                 source_map: str = None, report: bool = False, cache: bool = True):
     with open(input_file, "r") as ifile:
         source = ifile.read()
-        result = compile_to_brainfuck(source, debug_sym=True)
-        with open(output_file, "w") as ofile:
-            ofile.write(result)
+    if source_map is not None and (options.target != "bfpp" or options.format != "bf"):
+        error("--source-map only works with the bf format")
+    binary = options.target != "c" and options.format == "bfb"
+    # The source map and the report need the codegen so they skip the cache
+    cache = cache and source_map is None and not report
+    if cache:
+        key = compile_cache_key(source, options, source_loads(source, input_file))
+        cached = cache_load(key)
+        if cached is not None:
+            shutil.copyfile(cached, output_file)
+            return
+    codegen = make_codegen(source, options, input_file)
+    if options.target == "bfpp" and options.format == "bf" and not report:
+        # BF is streamed to a file next to output_file as it is emitted, an
+        # error leaves output_file as it was
+        temp = f"{output_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "wb") as file:
+                codegen.emit_all(file, mapped=source_map is not None)
+            os.replace(temp, output_file)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    else:
+        result = codegen.emit_all()
+        if options.target == "c":
+            data = bfpp.transpile_to_c(bfpp.lower(result)).encode()
+        elif options.format == "bfb":
+            data = bfpp.dump_bytecode(bfpp.lower(result), codegen.tape_size(), codegen.natives)
+        else:
+            data = result.encode()
+        write_output(output_file, data, binary)
+    if cache:
+        cache_store(key, output_file)
+    if source_map is not None:
+        codegen.source_map.file = input_file
+        codegen.source_map.save(source_map)
+    if report:
+        print(compile_report(codegen, result, source))
+
+# Batch compile
+#
+# `com -o outdir a.bfc b.bfc ...` compiles every source into outdir on a
+# pool of -j worker processes that share the import of the compiler and
+# the constant table. A source that fails is reported with what error()
+# printed and the others still compile.
+def output_name(input_file: str, options: CompileOptions) -> str:
+    extension = "c" if options.target == "c" else options.format
+    return os.path.splitext(os.path.basename(input_file))[0] + "." + extension
+
+def compile_job(input_file: str, output_file: str, options: CompileOptions, report: bool, cache: bool) -> dict:
+    # Compile one source in a worker. What it prints is kept in "log" so
+    # that sources compiled at the same time don't mix their output
+    result = { "error": False }
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        try:
+            compile_file(input_file, output_file, options, None, report, cache)
+        except SystemExit:
+            # error() reports the error and exits
+            result["error"] = True
+        except OSError as e:
+            print(f"ERROR: can't compile {input_file}: {e.strerror}")
+            result["error"] = True
+        except Exception as e:
+            # Anything else only fails this source
+            print(f"ERROR: can't compile {input_file}: {type(e).__name__}: {e}")
+            result["error"] = True
+    result["time"] = time.perf_counter() - start
+    result["log"] = log.getvalue()
+    return result
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("USAGE: bfcat <run|com> <source.bfcat> [output.bfcat]")
+def compile_batch(input_files: List[str], output_dir: str, options: CompileOptions = CompileOptions(),
+                  jobs: int = 0, report: bool = False, cache: bool = True) -> int:
+    # Returns how many sources failed
+    outputs = {}
+    for input_file in input_files:
+        output_file = os.path.join(output_dir, output_name(input_file, options))
+        if output_file in outputs:
+            error(f"{input_file} and {outputs[output_file]} would both be compiled into {output_file}")
+        outputs[output_file] = input_file
+    os.makedirs(output_dir, exist_ok=True)
+    # Build the cached constant table and hash the compiler once instead
+    # of in every worker
+    load_const_table()
+    compiler_hash()
+    jobs = jobs if jobs > 0 else os.cpu_count() or 1
+    jobs = max(min(jobs, len(input_files)), 1)
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        runs = []
+        for output_file, input_file in outputs.items():
+            runs.append((input_file, output_file, pool.submit(compile_job, input_file, output_file, options, report, cache)))
+        for input_file, output_file, future in runs:
+            result = future.result()
+            print(result["log"], end="")
+            if result["error"]:
+                print(f"+ {input_file} failed after {result['time'] * 1000:.1f}ms")
+                failed += 1
+            else:
+                print(f"+ {input_file} compiled into {output_file} in {result['time'] * 1000:.1f}ms")
+    print(f"{len(input_files)} sources, {len(input_files) - failed} compiled and {failed} failed in " +
+          f"{time.perf_counter() - start:.2f}s on {jobs} processes")
+    return failed
+
+# Compile report
+#
+# `com --report` goes over the emitted code without running it. Steps
+# are counted per straight-line region, the code an op emits between the
+# jumps of the while/if around it, as a polynomial in V: the most times a
+# loop of the region runs, which is the value of the operand it counts
+# down and at most 255. A loop nested in another one gives V^2 and so on,
+# but for the template loops of LOOP_COSTS.
+# Brackets matched outside the region are the jumps of a while/if and
+# count as a single step.
+REPORT_MAX_TRIPS = 255
+
+# Cost of the template loops whose passes share the work of their inner
+# loops, which region_cost would take for nested ones. The divmod loop
+# makes 25 steps a pass, one pass for every unit of Y, and refilling X
+# from R moves Y cells at most over all the passes. The doubling loop of
+# shr makes 8 steps a pass, X passes, and T goes 1, 2, 4... until it
+# wraps to 0 so its two inner loops run 255 times at most over all of them
+LOOP_COSTS = {
+    DIVMOD_LOOP: [ 1, 25 + 5 ],
+    SHR_LOOP: [ 1 + (5 + 6) * REPORT_MAX_TRIPS, 8 ],
+}
+
+def region_cost(code: str) -> List[int]:
+    # Coefficients of V^0, V^1... of the steps code takes at most. A loop
+    # whose body ends on an inner loop over the same cell runs once, the
+    # inner loop only stops on 0. That keeps the ladders of the comparisons
+    # linear. The loops of LOOP_COSTS come with their cost. Each open loop
+    # is [ cost, offset from its cell, ends on 0 ]
+    loops = [ [ [ 0 ], 0, False ] ]
+    i = 0
+    while i < len(code):
+        ch = code[i]
+        if ch == ";":
+            while i < len(code) and code[i] != "\n":
+                i += 1
+            continue
+        i += 1
+        if ch not in PEEPHOLE_OPS:
+            continue
+        top = loops[-1]
+        template = next((loop for loop in LOOP_COSTS if code.startswith(loop, i - 1)), None)
+        if template is not None:
+            # Both come back to their cell and leave it at 0
+            add_cost(top[0], LOOP_COSTS[template])
+            top[2] = top[1] == 0
+            i += len(template) - 1
+        elif ch == "[":
+            loops.append([ [ 0 ], 0, False ])
+        elif ch == "]" and len(loops) > 1:
+            cost, offset, once = loops.pop()
+            cost[0] += 1
+            add_cost(loops[-1][0], [ 1 ] + cost if not once else [ 1 + cost[0] ] + cost[1:])
+            if offset != 0:
+                loops[-1][1] = None
+            loops[-1][2] = loops[-1][1] == 0
+        else:
+            top[0][0] += 1
+            top[2] = False
+            if ch in "<>" and top[1] is not None:
+                top[1] += 1 if ch == ">" else -1
+    while len(loops) > 1:
+        cost, offset, once = loops.pop()
+        cost[0] += 1
+        add_cost(loops[-1][0], cost)
+        loops[-1][2] = False
+    return loops[0][0]
+
+def add_cost(total: List[int], cost: List[int]):
+    total.extend([ 0 ] * (len(cost) - len(total)))
+    for power, factor in enumerate(cost):
+        total[power] += factor
+
+def cost_text(cost: List[int]) -> str:
+    terms = []
+    for power, factor in enumerate(cost):
+        if factor == 0 and (power > 0 or len(cost) > 1):
+            continue
+        variable = "" if power == 0 else "V" if power == 1 else f"V^{power}"
+        terms.append(f"{factor}{variable}" if factor != 1 or power == 0 else variable)
+    return " + ".join(terms) if terms else "0"
+
+def cost_worst(cost: List[int], trips: int = REPORT_MAX_TRIPS) -> int:
+    return sum(factor * trips ** power for power, factor in enumerate(cost))
+
+def piece_extents(codegen: Codegen) -> List[int]:
+    # Highest tape cell each piece of codegen.result reaches, following the
+    # pointer from the dp an instruction starts at. A loop that doesn't
+    # come back where it started, like the index walks of the arrays or
+    # the skips of divmod, loses track of the pointer until the next
+    # instruction, so the scratch cells that instruction gave to `assume`
+    # count too.
+    extents = []
+    pos = 0
+    loops = []
+    for index, piece in enumerate(codegen.result):
+        if index in codegen.anchors:
+            pos = codegen.program.offset + codegen.anchors[index]
+        high = -1 if pos is None else pos
+        if index in codegen.reaches:
+            high = max(high, codegen.program.offset + codegen.reaches[index])
+        i = 0
+        while i < len(piece):
+            ch = piece[i]
+            if ch == ";":
+                while i < len(piece) and piece[i] != "\n":
+                    i += 1
+                continue
+            if pos is not None and ch in "<>":
+                pos += 1 if ch == ">" else -1
+                high = max(high, pos)
+            elif ch == "[":
+                loops.append(pos)
+            elif ch == "]" and loops:
+                if loops.pop() != pos:
+                    pos = None
+            i += 1
+        extents.append(high)
+    return extents
+
+def source_line(line_number: int, file: str, sources: Dict[str, List[str]]) -> str:
+    # The text of a line, sources has the lines of the file being compiled
+    # under "" and gets those of the modules as they are needed
+    if file not in sources:
+        try:
+            with open(file, "r") as f:
+                sources[file] = f.read().split("\n")
+        except OSError:
+            sources[file] = []
+    lines = sources[file]
+    return lines[line_number - 1].strip() if 0 < line_number <= len(lines) else "<generated>"
+
+def report_lines(codegen: Codegen, code: str, extents: List[int]) -> Dict[Tuple[str, int], list]:
+    # [ size, steps, highest cell ] of every source line keyed by (file,
+    # line), the file being compiled comes first. The highest cell is in
+    # cells from the start of the tape, arrays included
+    lines = {}
+    def entry(file: str, line_number: int) -> list:
+        return lines.setdefault((file, line_number), [ 0, [ 0 ], -1 ])
+    for index, high in enumerate(extents):
+        origin = codegen.origins.get(index, (0, "program", (), ""))
+        entry(origin[3], origin[0])[2] = max(entry(origin[3], origin[0])[2], high)
+    for start, end, line_number, op, frames, file in codegen.source_map.ranges:
+        item = entry(file, line_number)
+        item[0] += sum(1 for ch in code[start:end] if ch in PEEPHOLE_OPS)
+        add_cost(item[1], region_cost(code[start:end]))
+    return lines
+
+def compile_report(codegen: Codegen, code: str, source: str) -> str:
+    # Code size, steps and tape extent per source line and per macro
+    extents = piece_extents(codegen)
+    lines = report_lines(codegen, code, extents)
+    sources = { "": source.split("\n") }
+    width = max([ 5 ] + [ len(source_location(line_number, file)) for file, line_number in lines ])
+    report = []
+    report.append(f"{'line':>{width}} {'size':>7} {'worst':>10} {'tape':>6}  steps / source")
+    for file, line_number in sorted(lines):
+        size, cost, high = lines[(file, line_number)]
+        if size == 0:
+            continue
+        report.append(f"{source_location(line_number, file):>{width}} {size:7} {cost_worst(cost):10} {high + 1:6}  {cost_text(cost)}")
+        report.append(f"{'':{width + 27}}{source_line(line_number, file, sources)}")
+
+    if codegen.program.macro_lines:
+        report.append("")
+        report.append(f"{'macro':<16} {'lines':>9} {'size':>7} {'worst':>10} {'tape':>6}  steps")
+        for name, (first, last) in codegen.program.macro_lines.items():
+            size = 0
+            cost = [ 0 ]
+            high = -1
+            for line_number in range(first, last + 1):
+                if ("", line_number) in lines:
+                    size += lines[("", line_number)][0]
+                    add_cost(cost, lines[("", line_number)][1])
+                    high = max(high, lines[("", line_number)][2])
+            report.append(f"{name:<16} {f'{first}-{last}':>9} {size:7} {cost_worst(cost):10} {high + 1:6}  {cost_text(cost)}")
+
+    extent = max(extents, default=-1) + 1
+    stack = codegen.program.offset + codegen.max_dp
+    report.append("")
+    report.append(f"Code size: {sum(item[0] for item in lines.values())} BF instructions")
+    report.append(f"Tape: {codegen.program.offset} cells of arrays, stack up to {codegen.max_dp} cells, "
+                  f"{extent} cells touched ({max(extent - stack, 0)} scratch cells past the stack)")
+    report.append(f"Tape size reserved: {codegen.tape_size()} cells (bfpp has {bfpp.TAPE_LENGTH})")
+    return "\n".join(report)
+
+def profile_program(code: str, source_map: SourceMap) -> Tuple[int, Dict[Tuple[str, int], int], Dict[str, int]]:
+    # Run the program once counting how often every op runs, then charge
+    # the counts to the source line, keyed by (file, line) like in
+    # compile_report, and to the stack of while/if frames of the op they
+    # belong to
+    positions = []
+    ops = bfpp.lower(code, True, positions)
+    state = bfpp.State()
+    bfpp.register_bfcat_natives(state)
+    result, counts = bfpp.profile_ops(state, ops)
+    lines = {}
+    stacks = {}
+    for ip, count in enumerate(counts):
+        if count == 0:
+            continue
+        origin = source_map.lookup(positions[ip])
+        line_number, op, frames, file = origin[2:] if origin is not None else (0, "program", (), "")
+        lines[(file, line_number)] = lines.get((file, line_number), 0) + count
+        stack = ";".join(frames + (f"{source_location(line_number, file)}: {op}",))
+        stacks[stack] = stacks.get(stack, 0) + count
+    return result, lines, stacks
+
+def print_profile(lines: Dict[Tuple[str, int], int], source: str, top: int = 20):
+    sources = { "": source.split("\n") }
+    total = sum(lines.values())
+    print(f"Profile: {total} steps")
+    shown = sorted(lines.items(), key=lambda item: (-item[1], item[0]))[:top]
+    width = max([ 5 ] + [ len(source_location(line_number, file)) for (file, line_number), _ in shown ])
+    print(f"{'steps':>12} {'%':>6} {'line':>{width}}  source")
+    for (file, line_number), count in shown:
+        print(f"{count:12} {100 * count / total:5.1f}% {source_location(line_number, file):>{width}}  {source_line(line_number, file, sources)}")
+
+def write_folded(path: str, stacks: Dict[str, int], root: str):
+    # One `frame;frame;line: op count` per line, the input of flamegraph.pl
+    # and speedscope
+    with open(path, "w") as file:
+        for stack, count in sorted(stacks.items()):
+            file.write(f"{root};{stack} {count}\n")
+
+# Watch mode
+#
+# `bfcat2.py watch` compiles the file again every time it is saved and
+# reuses what didn't change. The source is cut into chunks, runs of whole
+# lines that no top-level def, array, while or if crosses. An edit only
+# tokenizes and parses the chunks it touched again, plus the chunks that
+# expand a macro whose definition changed. The instructions are then cut
+# into units, the plain code up to and including the next while or if or
+# the end of a chunk that doesn't end on something the next chunk could
+# fold with, and each unit keeps its BF for as long as its instructions,
+# the array layout and the tape it starts on (dp and what `cells` knows)
+# are the same. Folding runs on each unit and the peephole pass on the BF
+# of each unit, joining the units where ops cancel out across them, so
+# the output is the same as what `com` writes.
+#
+# Chunks after an edit keep their instructions even when the edit moved
+# them to other lines, the BF doesn't depend on lines. Errors are
+# reported by compiling everything again so their lines are right.
+chunk_serials = iter(range(1, 1 << 62))
+
+class Chunk(object):
+    def __init__(self, start: int, count: int, tokens: Tokens):
+        self.start = start
+        self.count = count
+        self.tokens = tokens
+        self.serial = next(chunk_serials)
+        self.insts = None
+        # Positions of the while and if in insts
+        self.blocks = []
+        # The macros it expanded and the ones it defined, by name
+        self.uses = {}
+        self.macros = {}
+        # The arrays it defined as (name, size) and the (path, key) of the
+        # modules it loaded
+        self.arrays = []
+        self.loads = []
+
+    def end(self) -> int:
+        return self.start + self.count
+
+class ChunkParser(Parser):
+    # Parses a chunk with the macros of the chunks before it, recording
+    # which of those it expanded
+    def __init__(self, tokens: Tokens, macros: Dict[str, Macro], directory: str = ".", loading: Tuple[str, ...] = ()):
+        super().__init__(tokens, directory, loading)
+        self.program.macros = dict(macros)
+        self.outer = macros
+        self.uses = {}
+
+    def expand_macro(self, name: str) -> Macro:
+        macro = super().expand_macro(name)
+        if self.outer.get(name) is macro:
+            self.uses[name] = macro
+        return macro
+
+def split_chunks(lines: List[str], start: int) -> Tuple[List[Chunk], bool]:
+    # Chunks of lines, the first one being line `start` (0 based) of the
+    # source. Also tells whether the last chunk is still open
+    tokens = parse_tokens("\n".join(lines), start + 1)
+    chunks = []
+    depth = 0
+    first_line = 0
+    first_token = 0
+    kinds, token_lines = tokens.kinds, tokens.lines
+    i = 0
+    for k in range(len(lines)):
+        while i < len(kinds) and token_lines[i] == start + k + 1:
+            if kinds[i] in (TOK_WHILE, TOK_IF, TOK_DEF, TOK_ARRAY):
+                depth += 1
+            elif kinds[i] == TOK_END:
+                depth = max(depth - 1, 0)
+            i += 1
+        if depth == 0:
+            chunks.append(Chunk(start + first_line, k + 1 - first_line, tokens[first_token:i]))
+            first_line = k + 1
+            first_token = i
+    if first_line < len(lines):
+        chunks.append(Chunk(start + first_line, len(lines) - first_line, tokens[first_token:]))
+    return chunks, depth > 0
+
+def common_prefix(a: List[str], b: List[str]) -> int:
+    # Number of leading items a and b share, comparing slices so that the
+    # work happens in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def ends_with_block(insts: List[Inst]) -> bool:
+    return len(insts) > 0 and is_block(insts[-1])
+
+class Watcher(object):
+    def __init__(self, options: CompileOptions = None, path: str = None):
+        self.options = options if options is not None else CompileOptions()
+        # Where `load` paths are relative to
+        self.directory = os.path.dirname(path) if path is not None else "."
+        self.loading = (os.path.abspath(path),) if path is not None else ()
+        self.lines = []
+        self.chunks = []
+        self.output = None
+        # Unit key to (folded instructions, array counts) and the state a
+        # unit is emitted in to (code, dp, cells), both only keep what the
+        # last update used
+        self.units = {}
+        self.emitted = {}
+        # (pieces, at start) to what the peephole pass gave, see peephole
+        self.passes = {}
+        # What the last update did again
+        self.parsed = 0
+        self.emits = 0
+        self.unit_count = 0
+
+    def modules(self) -> List[str]:
+        # The paths of every module the chunks loaded
+        return sorted({ path for chunk in self.chunks for path, _ in chunk.loads })
+
+    def modules_changed(self) -> bool:
+        return any(module_changed(path, key) for chunk in self.chunks for path, key in chunk.loads)
+
+    def update(self, source: str) -> str:
+        lines = source.splitlines()
+        prefix = common_prefix(self.lines, lines)
+        if prefix == len(lines) == len(self.lines) and self.output is not None and not self.modules_changed():
+            self.parsed = self.emits = 0
+            return self.output
+        suffix = common_prefix(self.lines[prefix:][::-1], lines[prefix:][::-1])
+        old_end = len(self.lines) - suffix
+        delta = len(lines) - len(self.lines)
+
+        # Chunks i up to j are the ones the edit touched, lexed again until
+        # the last one is closed
+        starts = [ chunk.start for chunk in self.chunks ]
+        i = bisect.bisect_right(starts, prefix) - 1 if prefix < len(self.lines) else len(self.chunks)
+        j = max(bisect.bisect_left(starts, max(old_end, prefix + 1)), i)
+        while True:
+            low = self.chunks[i].start if i < len(self.chunks) else len(self.lines)
+            high = self.chunks[j - 1].end() if j > i else low
+            fresh, still_open = split_chunks(lines[low:high + delta], low)
+            if not still_open or j == len(self.chunks):
+                break
+            j += 1
+
+        rest = self.chunks[j:]
+        for chunk in rest:
+            chunk.start += delta
+        chunks = self.chunks[:i] + fresh + rest
+        try:
+            output, parsed = self.rebuild(chunks)
+        except BaseException:
+            for chunk in rest:
+                chunk.start -= delta
+            raise
+        for chunk, (serial, insts, blocks, uses, macros, arrays, loads) in parsed.items():
+            chunk.serial, chunk.insts, chunk.blocks = serial, insts, blocks
+            chunk.uses, chunk.macros, chunk.arrays, chunk.loads = uses, macros, arrays, loads
+        self.lines = lines
+        self.chunks = chunks
+        self.output = output
+        return output
+
+    def rebuild(self, chunks: List[Chunk]) -> Tuple[str, dict]:
+        # Parse what changed, nothing is stored on the chunks until the
+        # whole source compiled
+        parsed = {}
+        macros = {}
+        arrays = {}
+        for chunk in chunks:
+            if (chunk.insts is None or chunk.uses and any(macros.get(name) is not macro for name, macro in chunk.uses.items()) or
+                    chunk.loads and any(module_changed(path, key) for path, key in chunk.loads)):
+                parser = ChunkParser(chunk.tokens, macros, self.directory, self.loading)
+                parser.parse()
+                body = parser.program.body
+                # A new serial, the units of the old instructions are stale
+                parsed[chunk] = (next(chunk_serials), body, [ k for k, inst in enumerate(body) if is_block(inst) ],
+                                 parser.uses, { name: macro for name, macro in parser.program.macros.items() if macros.get(name) is not macro },
+                                 [ (name, array.size) for name, array in parser.program.arrays.items() ], parser.loads)
+            defined, defined_arrays = parsed[chunk][4:6] if chunk in parsed else (chunk.macros, chunk.arrays)
+            macros.update(defined)
+            for name, size in defined_arrays:
+                arrays[name] = ArraySpec(size, 0)
+
+        units = {}
+        order = []
+        segments = []
+        for index, chunk in enumerate(chunks):
+            serial, body, blocks = parsed[chunk][:3] if chunk in parsed else (chunk.serial, chunk.insts, chunk.blocks)
+            low = 0
+            for block in blocks + [ None ]:
+                high = len(body) if block is None else block + 1
+                if high > low:
+                    segments.append((serial, low, high, body))
+                low = high
+                if not segments:
+                    continue
+                key = tuple(segment[:3] for segment in segments)
+                unit = self.units.get(key) or units.get(key)
+                if unit is None:
+                    unit = self.fold([ inst for _, low_, high_, body_ in segments for inst in body_[low_:high_] ])
+                # A while or if that folded away doesn't end the unit and
+                # neither does the end of a chunk that ends on something the
+                # next one could still fold with. The end of the source does
+                if ends_with_block(unit[0]) or block is None and (not unit[2] or index == len(chunks) - 1):
+                    units[key] = unit
+                    order.append(key)
+                    segments = []
+
+        counts = {}
+        for key in order:
+            for name, count in units[key][1].items():
+                counts[name] = counts.get(name, 0) + count
+        program = Program([], macros, arrays)
+        place_arrays(program, counts)
+        layout = (program.offset,) + tuple((name, array.offset) for name, array in arrays.items())
+
+        emitted = {}
+        pieces = []
+        if program.offset > 0:
+            if self.options.annotate:
+                pieces.append(";; Aggregate Array Offset")
+            pieces.append(">" * program.offset + "\n")
+        # The tape a unit ends on as dp, cells and cells as a sorted tuple
+        dp, cells, known = 0, {}, ()
+        self.emits = 0
+        for key in order:
+            state = (key, dp, known, layout)
+            unit = self.emitted.get(state) or emitted.get(state)
+            if unit is None:
+                codegen = Codegen(program, self.options)
+                codegen.dp = codegen.max_dp = dp
+                codegen.cells = dict(cells)
+                codegen.emit_insts(units[key][0])
+                unit = ("\n".join(codegen.result), codegen.dp, codegen.cells, tuple(sorted(codegen.cells.items())))
+                self.emits += 1
+            emitted[state] = unit
+            code, dp, cells, known = unit
+            if code:
+                pieces.append(code)
+
+        self.parsed = len(parsed)
+        self.unit_count = len(order)
+        self.units = units
+        self.emitted = emitted
+        output = self.peephole(pieces) if self.options.peephole else "\n".join(pieces)
+        return output, parsed
+
+    def peephole(self, pieces: List[str]) -> str:
+        # The peephole pass over the pieces gives what it gives over the
+        # whole code as long as the last op of a piece never meets one of
+        # the entry ops of the next one that cancels it out or is a dead
+        # loop after it. Pieces where that happens go through it again
+        # together, and what it gave is kept for the next update. Each run
+        # is (pieces, code, first op, last op, entry ops, whether any run up
+        # to it has ops)
+        runs = []
+        passes = {}
+        for piece in pieces:
+            joined = (piece,)
+            while True:
+                at_start = not runs or not runs[-1][5]
+                key = (joined, at_start)
+                result = self.passes.get(key) or passes.get(key)
+                if result is None:
+                    code = "\n".join(joined)
+                    output = peephole(code, at_start)
+                    result = (output,) + edge_ops(output) + (entry_ops(code),)
+                passes[key] = result
+                last = len(runs)
+                while last > 0 and runs[last - 1][2] == "":
+                    last -= 1
+                if last == 0 or not peephole_joins(runs[last - 1][3], result[3]):
+                    break
+                joined = tuple(piece for run in runs[last - 1:] for piece in run[0]) + joined
+                del runs[last - 1:]
+            runs.append((joined,) + result + ((runs[-1][5] if runs else False) or result[1] != "",))
+        self.passes = passes
+        return "\n".join(run[1] for run in runs if run[1])
+
+    def fold(self, insts: List[Inst]) -> Tuple[List[Inst], Dict[str, int], bool]:
+        # Also tells whether the instructions end on a value that folding
+        # could still consume or a shuffle the stack peephole could still
+        # fuse, the only things that reach into the instructions before
+        if self.options.fold:
+            insts = fold_constants(insts)
+        loose = len(insts) > 0 and isinstance(insts[-1], Integer)
+        if self.options.fuse:
+            insts = fuse_stack_ops(insts)
+        loose = loose or len(insts) > 0 and (isinstance(insts[-1], Integer) or is_intrinsic(insts[-1], "dup", "over", "swap"))
+        counts = {}
+        count_array_ops(insts, counts)
+        return insts, counts, loose
+
+def file_stamps(paths: List[str]) -> Optional[Tuple[int, ...]]:
+    try:
+        return tuple(os.stat(path).st_mtime_ns for path in paths)
+    except OSError:
+        return None
+
+def watch(input_file: str, output_file: str, options: CompileOptions, run: bool = False, interval: float = 0.2):
+    # Compile input_file every time it or a module it loads changes until
+    # interrupted, an error leaves output_file as it was
+    watcher = Watcher(options, input_file)
+    stamp = None
+    while True:
+        current = file_stamps([input_file] + watcher.modules())
+        if current is None or current == stamp:
+            time.sleep(interval)
+            continue
+        stamp = current
+        with open(input_file, "r") as file:
+            source = file.read()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                output = watcher.update(source)
+        except (SystemExit, Exception):
+            # Compile everything again for an error with the right lines
+            watcher = Watcher(options, input_file)
+            try:
+                output = watcher.update(source)
+            except SystemExit:
+                continue
+            except Exception as e:
+                print(f"ERROR: can't compile {input_file}: {type(e).__name__}: {e}")
+                continue
+        elapsed = (time.perf_counter() - start) * 1000
+        # With the modules this compile loaded
+        stamp = file_stamps([input_file] + watcher.modules())
+        with open(output_file, "w") as file:
+            file.write(output)
+        print(f"Compiled {input_file} into {output_file} in {elapsed:.1f}ms, parsed {watcher.parsed} " +
+              f"chunks and emitted {watcher.emits} of {watcher.unit_count} units")
+        if run:
+            state = bfpp.State()
+            bfpp.register_bfcat_natives(state)
+            bfpp.eval_program(state, output)
+            sys.stdout.flush()
+
+def main():
+    parser = optparse.OptionParser(usage="bfcat <run|com|prof|watch> <source.bfcat> [output.bfcat]\n" +
+                                         "       bfcat com [-j N] -o <outdir> <source.bfcat>...")
+    parser.add_option("--format", dest="format", default="bf", choices=OUTPUT_FORMATS,
+                      help="Output format of com: bf (text) or bfb (pre-linked bytecode)")
+    parser.add_option("--target", dest="target", default="bfpp", choices=TARGETS,
+                      help="Target of com: bfpp (run by an interpreter) or c (a C translation unit to build with src/)")
+    parser.add_option("--const-cost", dest="const_cost", default="steps", choices=CONST_COSTS,
+                      help="Materialize integer literals with the fewest executed steps or the smallest code")
+    parser.add_option("--no-fold", dest="fold", default=True, action="store_false",
+                      help="Don't evaluate operations on known constants at compile time")
+    parser.add_option("--no-specialize", dest="specialize", default=True, action="store_false",
+                      help="Always use the generic intrinsic templates, even when an operand is a literal")
+    parser.add_option("--no-peephole", dest="peephole", default=True, action="store_false",
+                      help="Don't clean up the emitted BF with the peephole pass")
+    parser.add_option("--no-fuse", dest="fuse", default=True, action="store_false",
+                      help="Don't drop no-op stack shuffles or fuse common sequences into superinstructions")
+    parser.add_option("--native-ops", dest="native_ops", default=False, action="store_true",
+                      help="Lower comparisons, mul/div/mod and array access to `!` calls on the natives reserved by bfpp")
+    parser.add_option("--unroll", dest="unroll", default=False, action="store_true",
+                      help="Unroll while loops with a known trip count and count the others down")
+    parser.add_option("--unroll-budget", dest="unroll_budget", default=UNROLL_BUDGET, type="int",
+                      help=f"Most BF characters a single unrolled loop may take (default {UNROLL_BUDGET})")
+    parser.add_option("--no-annotations", dest="annotate", default=True, action="store_false",
+                      help="Leave the `;;` comments naming each template out of the BF")
+    parser.add_option("--source-map", dest="source_map", default=None,
+                      help="Also write a JSON map from ranges of the output of com back to source lines")
+    parser.add_option("--no-cache", dest="cache", default=True, action="store_false",
+                      help="Always compile instead of reusing the output cached in build/bfcat-cache")
+    parser.add_option("-o", "--output-dir", dest="output_dir", default=None,
+                      help="Compile every source given to com into this directory")
+    parser.add_option("-j", "--jobs", dest="jobs", default=0, type="int",
+                      help="Processes that compile the sources of com -o (default: one per core)")
+    parser.add_option("--report", dest="report", default=False, action="store_true",
+                      help="Print the code size, worst case steps and tape extent of every source line and macro")
+    parser.add_option("--top", dest="top", default=20, type="int",
+                      help="Number of lines in the report of prof (default 20)")
+    parser.add_option("--run", dest="run", default=False, action="store_true",
+                      help="Run the program after every compile of watch")
+    parser.add_option("--interval", dest="interval", default=0.2, type="float",
+                      help="Seconds between the checks of watch for a change of the source (default 0.2)")
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        print("USAGE: bfcat <run|com|prof|watch> <source.bfcat> [output.bfcat]")
         exit(-1)
 
-    outputfile = "a.bf"
-    if len(sys.argv) == 4:
-        outputfile = sys.argv[3]
-    if sys.argv[1] == "com":
-        compile_file(sys.argv[2], outputfile)
-    elif sys.argv[1] == "run":
-        import subprocess
-        compile_file(sys.argv[2], outputfile)
-        subprocess.run(["./build/bfpp.exe", outputfile])
+    compile_options = CompileOptions(options.format, options.target, options.const_cost,
+                                     options.fold, options.specialize, options.peephole, options.fuse,
+                                     options.native_ops, options.unroll, options.unroll_budget, options.annotate)
+    outputfile = "a.c" if options.target == "c" else "a." + options.format
+    if len(args) == 3:
+        outputfile = args[2]
+    if args[0] == "com" and options.output_dir is not None:
+        if options.source_map is not None:
+            error("--source-map only works with a single source")
+        failed = compile_batch(args[1:], options.output_dir, compile_options, options.jobs, options.report, options.cache)
+        exit(1 if failed > 0 else 0)
+    elif args[0] == "com":
+        compile_file(args[1], outputfile, compile_options, options.source_map, options.report, options.cache)
+    elif args[0] == "prof":
+        with open(args[1], "r") as ifile:
+            source = ifile.read()
+        result, source_map = compile_with_source_map(source, args[1], compile_options)
+        code, lines, stacks = profile_program(result, source_map)
+        print_profile(lines, source, options.top)
+        foldedfile = args[2] if len(args) == 3 else "a.folded"
+        write_folded(foldedfile, stacks, os.path.basename(args[1]))
+        print(f"Folded stacks written to {foldedfile}")
+        exit(code)
+    elif args[0] == "watch":
+        # Always BF text, --format and --target only apply to com
+        try:
+            watch(args[1], args[2] if len(args) == 3 else "a.bf", compile_options, options.run, options.interval)
+        except KeyboardInterrupt:
+            pass
+    elif args[0] == "run":
+        with open(args[1], "r") as ifile:
+            result = compile_to_brainfuck(ifile.read(), options=compile_options, path=args[1])
+        if len(args) == 3:
+            with open(outputfile, "w") as ofile:
+                ofile.write(result)
+        state = bfpp.State()
+        bfpp.register_bfcat_natives(state)
+        exit(bfpp.eval_program(state, result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,636 @@
+#
+# In-process BFPP interpreter.
+# This is the Python counterpart of src/bfpp.c so bfcat2.py
+# and runtest.py can execute compiled programs from memory
+# without needing build/bfpp.exe to exist.
+#
+
+from __future__ import annotations
+import sys
+from typing import Callable, List, Optional, Set, TextIO, Tuple
+
+TAPE_LENGTH = 30000
+
+# A native function receives the state and the 8 argument bytes
+# (args[0] is the cell right before the slot index) and returns the
+# byte that replaces the slot index on the tape. Same as `NativeFunc`
+# in src/bfpp.h.
+NativeFunc = Callable[["State", bytes], int]
+
+class State(object):
+    def __init__(self, output: Optional[TextIO] = None, tape_length: int = TAPE_LENGTH):
+        self.natives: List[Optional[NativeFunc]] = [None] * 256
+        self.data = bytearray(tape_length)
+        self.dp = 0
+        self.ip = 0
+        self.steps = 0
+        self.output = output if output is not None else sys.stdout
+
+    def write_text(self, text: str):
+        self.output.write(text)
+
+    def flush(self):
+        self.output.write("\n")
+
+def reset_state(state: State):
+    state.dp = 0
+    state.data[:] = bytes(len(state.data))
+
+class LinkError(Exception):
+    def __init__(self, message: str, code: int):
+        super().__init__(message)
+        self.code = code
+
+# Operations of the lowered program. Each op is a (kind, arg) tuple.
+OP_ADD     = 0  # data[dp] += arg
+OP_MOVE    = 1  # dp += arg
+OP_CLEAR   = 2  # data[dp] = 0
+OP_SET     = 3  # data[dp] = arg
+OP_MUL     = 4  # arg = (pairs, lo, hi): data[dp+off] += data[dp]*factor then data[dp] = 0
+OP_SCAN    = 5  # while data[dp] != 0: dp += arg
+OP_JZ      = 6  # if data[dp] == 0 jump past the matching OP_JNZ at index arg
+OP_JNZ     = 7  # if data[dp] != 0 jump past the matching OP_JZ at index arg
+OP_OUT     = 8  # '.'
+OP_DBG     = 9  # '?'
+OP_CALL    = 10 # '!'
+OP_RESET   = 11 # '$'
+OP_INVALID = 12 # unknown instruction, arg is the character
+
+SIMPLE_OPS = {
+    ".": OP_OUT,
+    "?": OP_DBG,
+    "!": OP_CALL,
+    "$": OP_RESET,
+}
+
+def fuse_loop(body: List[Tuple]) -> Optional[Tuple]:
+    """
+    Recognize a loop made only of OP_ADD/OP_MOVE as a single op.
+    `[>]`-like loops become OP_SCAN, balanced loops that step the
+    current cell by -1 or +1 (`[-]`, `[->+<]`, `[->+>+<<]`, `[-<->]`...)
+    become OP_CLEAR or OP_MUL.
+    """
+    if len(body) == 1 and body[0][0] == OP_MOVE:
+        return (OP_SCAN, body[0][1])
+    offset = 0
+    deltas = {}
+    for kind, arg in body:
+        if kind == OP_ADD:
+            deltas[offset] = deltas.get(offset, 0) + arg
+        elif kind == OP_MOVE:
+            offset += arg
+        else:
+            return None
+    if offset != 0:
+        return None
+    step = deltas.pop(0, 0) & 0xFF
+    if step == 0xFF:
+        sign = 1
+    elif step == 1:
+        sign = -1
+    else:
+        return None
+    pairs = tuple((off, (delta * sign) & 0xFF) for off, delta in sorted(deltas.items()) if delta & 0xFF)
+    if not pairs:
+        return (OP_CLEAR, 0)
+    return (OP_MUL, (pairs, pairs[0][0], pairs[-1][0]))
+
+def lower(program: str, optimize: bool = True, positions: Optional[List[int]] = None) -> List[Tuple]:
+    """
+    Lower BFPP source into a list of ops with every bracket resolved.
+    Comments and whitespace are dropped. With `optimize` runs of
+    +-<> are collapsed and common loop idioms are fused (see fuse_loop),
+    without it every instruction becomes exactly one op. `positions`
+    gets the index in program of the first character of every op.
+    """
+    ops: List[Tuple] = []
+    where: List[int] = []
+    loops: List[int] = []
+    i = 0
+    size = len(program)
+    while i < size:
+        ch = program[i]
+        i += 1
+        if ch == "+" or ch == "-":
+            delta = 1 if ch == "+" else -1
+            if optimize and ops:
+                kind, arg = ops[-1]
+                if kind == OP_ADD:
+                    ops[-1] = (OP_ADD, (arg + delta) & 0xFF)
+                    if ops[-1][1] == 0:
+                        ops.pop()
+                        where.pop()
+                    continue
+                if kind == OP_CLEAR or kind == OP_SET:
+                    ops[-1] = (OP_SET, (arg + delta) & 0xFF)
+                    continue
+            ops.append((OP_ADD, delta & 0xFF))
+            where.append(i - 1)
+        elif ch == ">" or ch == "<":
+            delta = 1 if ch == ">" else -1
+            if optimize and ops and ops[-1][0] == OP_MOVE:
+                ops[-1] = (OP_MOVE, ops[-1][1] + delta)
+                if ops[-1][1] == 0:
+                    ops.pop()
+                    where.pop()
+                continue
+            ops.append((OP_MOVE, delta))
+            where.append(i - 1)
+        elif ch == "[":
+            loops.append(len(ops))
+            ops.append((OP_JZ, 0))
+            where.append(i - 1)
+        elif ch == "]":
+            if not loops:
+                raise LinkError(f"ERROR: could not find matching  '[' for ']' at {i - 1}", -3)
+            start = loops.pop()
+            fused = fuse_loop(ops[start + 1:]) if optimize else None
+            if fused is None:
+                ops[start] = (OP_JZ, len(ops))
+                ops.append((OP_JNZ, start))
+                where.append(i - 1)
+                continue
+            at = where[start]
+            del ops[start:]
+            del where[start:]
+            if fused[0] == OP_CLEAR and ops and ops[-1][0] in (OP_ADD, OP_SET, OP_CLEAR):
+                ops.pop()
+                where.pop()
+            ops.append(fused)
+            where.append(at)
+        elif ch == ";":
+            while i < size and program[i] != "\n":
+                i += 1
+        elif ch in SIMPLE_OPS:
+            ops.append((SIMPLE_OPS[ch], 0))
+            where.append(i - 1)
+        elif ch not in " \t\r\n":
+            ops.append((OP_INVALID, ch))
+            where.append(i - 1)
+    if loops:
+        raise LinkError(f"ERROR: could not find matching  ']' for '[' at {loops[-1]}", -2)
+    if positions is not None:
+        positions.extend(where)
+    return ops
+
+def profile_ops(state: State, ops: List[Tuple]) -> Tuple[int, List[int]]:
+    """
+    Run ops like eval_ops and also return how many times each op ran.
+    Only the jumps count, every op after a jump starts a run of ops that
+    all execute as many times as control reaches its first one.
+    """
+    entries = [ 0 ] * (len(ops) + 1)
+    entries[0] = 1
+    code = eval_ops(state, ops, entries)
+    counts = []
+    current = 0
+    for ip in range(len(ops)):
+        if ip == 0 or ops[ip - 1][0] in (OP_JZ, OP_JNZ):
+            current = entries[ip]
+        counts.append(current)
+    return code, counts
+
+def eval_program(state: State, program: str, optimize: bool = True) -> int:
+    """
+    Run a BFPP program. Return codes follow eval_program in src/bfpp.c:
+    0 on success, -1 unknown instruction, -2/-3 unbalanced brackets,
+    -4 missing native function and -5 data pointer out of bounds.
+    """
+    try:
+        ops = lower(program, optimize)
+    except LinkError as e:
+        state.write_text(str(e))
+        state.flush()
+        return e.code
+    return eval_ops(state, ops)
+
+def eval_ops(state: State, ops: List[Tuple], entries: Optional[List[int]] = None) -> int:
+    """
+    Run ops produced by lower(). state.steps is increased by the
+    number of ops dispatched. `entries` (one more than the ops) counts
+    the index every jump continues at, see profile_ops.
+    """
+    data = state.data
+    tape_length = len(data)
+    dp = 0
+    ip = 0
+    steps = 0
+    size = len(ops)
+    code = 0
+    while ip < size:
+        kind, arg = ops[ip]
+        steps += 1
+        if kind == OP_ADD:
+            data[dp] = (data[dp] + arg) & 0xFF
+        elif kind == OP_MOVE:
+            dp += arg
+            if dp < 0 or dp >= tape_length:
+                code = -5
+                break
+        elif kind == OP_JZ:
+            if data[dp] == 0:
+                ip = arg
+            if entries is not None:
+                entries[ip + 1] += 1
+        elif kind == OP_JNZ:
+            if data[dp] != 0:
+                ip = arg
+            if entries is not None:
+                entries[ip + 1] += 1
+        elif kind == OP_CLEAR:
+            data[dp] = 0
+        elif kind == OP_SET:
+            data[dp] = arg
+        elif kind == OP_MUL:
+            value = data[dp]
+            if value:
+                pairs, lo, hi = arg
+                if dp + lo < 0 or dp + hi >= tape_length:
+                    dp = dp + lo if dp + lo < 0 else dp + hi
+                    code = -5
+                    break
+                for off, factor in pairs:
+                    data[dp + off] = (data[dp + off] + value * factor) & 0xFF
+                data[dp] = 0
+        elif kind == OP_SCAN:
+            if data[dp]:
+                if arg == 1:
+                    dp = data.find(0, dp)
+                    if dp < 0:
+                        dp = tape_length
+                elif arg == -1:
+                    dp = data.rfind(0, 0, dp)
+                else:
+                    while 0 <= dp < tape_length and data[dp]:
+                        dp += arg
+                if dp < 0 or dp >= tape_length:
+                    code = -5
+                    break
+        elif kind == OP_OUT:
+            state.write_text(chr(data[dp]))
+            state.flush()
+        elif kind == OP_DBG:
+            state.write_text(f"[dp={dp}] {data[dp]}")
+            state.flush()
+        elif kind == OP_CALL:
+            state.dp, state.ip = dp, ip
+            if call_native(state, dp) is None:
+                code = -4
+                break
+        elif kind == OP_RESET:
+            dp = 0
+        else:
+            state.write_text(f"ERROR: unknown instruction '{arg}'")
+            state.flush()
+            code = -1
+            break
+        ip += 1
+
+    if code == -5:
+        if dp < 0:
+            state.write_text("ERROR: data pointer is already zero could not decrement it anymore")
+        else:
+            state.write_text("ERROR: data pointer is already maxed could not increment it anymore")
+        state.flush()
+        dp = min(max(dp, 0), tape_length - 1)
+    state.dp, state.ip = dp, ip
+    state.steps += steps
+    return code
+
+# Pre-linked bytecode (.bfb)
+#
+# header: BYTECODE_MAGIC, u32 tape size (0 means TAPE_LENGTH),
+#         32 bytes bitmap of the native slots the program calls,
+#         u32 number of ops
+# ops:    u8 kind followed by its operands. Integers are LEB128 varints,
+#         signed ones zigzag encoded. OP_JZ/OP_JNZ carry the index of
+#         the matching op so the loader never matches brackets.
+BYTECODE_MAGIC = b"BFB\x01"
+
+class Bytecode(object):
+    def __init__(self, ops: List[Tuple], tape_size: int, natives: Set[int]):
+        self.ops = ops
+        self.tape_size = tape_size
+        self.natives = natives
+
+    def __repr__(self):
+        return f"Bytecode(ops={len(self.ops)}, tape_size={self.tape_size}, natives={sorted(self.natives)})"
+
+def write_varint(out: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def read_varint(blob: bytes, i: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = blob[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+def dump_bytecode(ops: List[Tuple], tape_size: int = 0, natives: Set[int] = set()) -> bytes:
+    out = bytearray(BYTECODE_MAGIC)
+    out += tape_size.to_bytes(4, "little")
+    bitmap = 0
+    for slot in natives:
+        bitmap |= 1 << slot
+    out += bitmap.to_bytes(32, "little")
+    out += len(ops).to_bytes(4, "little")
+    for kind, arg in ops:
+        out.append(kind)
+        if kind == OP_ADD or kind == OP_SET:
+            out.append(arg)
+        elif kind == OP_MOVE or kind == OP_SCAN:
+            write_varint(out, zigzag(arg))
+        elif kind == OP_JZ or kind == OP_JNZ:
+            write_varint(out, arg)
+        elif kind == OP_MUL:
+            pairs = arg[0]
+            write_varint(out, len(pairs))
+            for off, factor in pairs:
+                write_varint(out, zigzag(off))
+                out.append(factor)
+        elif kind == OP_INVALID:
+            out.append(ord(arg) & 0xFF)
+    return bytes(out)
+
+def load_bytecode(blob: bytes) -> Bytecode:
+    if blob[:4] != BYTECODE_MAGIC:
+        raise LinkError("ERROR: not a BFPP bytecode file", -1)
+    tape_size = int.from_bytes(blob[4:8], "little")
+    bitmap = int.from_bytes(blob[8:40], "little")
+    natives = set(slot for slot in range(256) if bitmap & (1 << slot))
+    count = int.from_bytes(blob[40:44], "little")
+    ops: List[Tuple] = []
+    i = 44
+    for _ in range(count):
+        kind = blob[i]
+        i += 1
+        if kind == OP_ADD or kind == OP_SET:
+            arg = blob[i]
+            i += 1
+        elif kind == OP_MOVE or kind == OP_SCAN:
+            value, i = read_varint(blob, i)
+            arg = unzigzag(value)
+        elif kind == OP_JZ or kind == OP_JNZ:
+            arg, i = read_varint(blob, i)
+        elif kind == OP_MUL:
+            length, i = read_varint(blob, i)
+            pairs = []
+            for _ in range(length):
+                off, i = read_varint(blob, i)
+                pairs.append((unzigzag(off), blob[i]))
+                i += 1
+            arg = (tuple(pairs), pairs[0][0], pairs[-1][0])
+        elif kind == OP_INVALID:
+            arg = chr(blob[i])
+            i += 1
+        else:
+            arg = 0
+        ops.append((kind, arg))
+    return Bytecode(ops, tape_size, natives)
+
+def eval_bytecode(state: State, blob: bytes) -> int:
+    try:
+        bytecode = load_bytecode(blob)
+    except LinkError as e:
+        state.write_text(str(e))
+        state.flush()
+        return e.code
+    if bytecode.tape_size > len(state.data):
+        state.write_text(f"ERROR: program needs a tape of {bytecode.tape_size} cells but only {len(state.data)} are available")
+        state.flush()
+        return -5
+    return eval_ops(state, bytecode.ops)
+
+# C backend
+#
+# Turns lowered ops into a C translation unit defining eval_compiled()
+# from src/bfpp.h. Link it with src/bfpp.c and src/main.c built with
+# -DBFPP_COMPILED so the natives registered in main.c are available.
+
+C_PRELUDE = """#include <string.h>
+#include "bfpp.h"
+
+static inline int bounds_error(long dp)
+{
+    if(dp < 0) platform_logger_write_text("ERROR: data pointer is already zero could not decrement it anymore");
+    else platform_logger_write_text("ERROR: data pointer is already maxed could not increment it anymore");
+    platform_logger_flush();
+    return -5;
+}
+
+static inline int call_native(State *state, long dp)
+{
+    Byte pfn = state->data[dp];
+    if(state->natives[(size_t)pfn] == NULL) {
+        platform_logger_write_text("ERROR: invalid native function with index ");
+        platform_logger_write_int(pfn);
+        platform_logger_flush();
+        return -4;
+    }
+    Byte a[8] = {0};
+    for(int i = 0; i < 8; ++i) {
+        if(dp - 1 - i >= 0) a[i] = state->data[dp - 1 - i];
+    }
+    state->dp = (size_t)dp;
+    state->data[dp] = state->natives[(size_t)pfn](state, a);
+    return 0;
+}
+
+#define CHECK(p) if((p) < 0 || (p) >= TAPE_LENGTH) return bounds_error(p)
+
+int eval_compiled(State *state)
+{
+    Byte *data = state->data;
+    long dp = 0;
+    (void)data;
+"""
+
+def transpile_to_c(ops: List[Tuple]) -> str:
+    lines = [ C_PRELUDE ]
+    depth = 1
+    for kind, arg in ops:
+        indent = "    " * depth
+        if kind == OP_ADD:
+            lines.append(f"{indent}data[dp] += {arg};")
+        elif kind == OP_MOVE:
+            lines.append(f"{indent}dp += {arg}; CHECK(dp);")
+        elif kind == OP_CLEAR:
+            lines.append(f"{indent}data[dp] = 0;")
+        elif kind == OP_SET:
+            lines.append(f"{indent}data[dp] = {arg};")
+        elif kind == OP_MUL:
+            pairs, lo, hi = arg
+            lines.append(f"{indent}if(data[dp]) {{")
+            lines.append(f"{indent}    CHECK(dp + {lo}); CHECK(dp + {hi});")
+            for off, factor in pairs:
+                lines.append(f"{indent}    data[dp + {off}] += data[dp] * {factor};")
+            lines.append(f"{indent}    data[dp] = 0;")
+            lines.append(f"{indent}}}")
+        elif kind == OP_SCAN:
+            if arg == 1:
+                lines.append(f"{indent}if(data[dp]) {{")
+                lines.append(f"{indent}    Byte *zero = memchr(&data[dp], 0, TAPE_LENGTH - dp);")
+                lines.append(f"{indent}    if(zero == NULL) return bounds_error(TAPE_LENGTH);")
+                lines.append(f"{indent}    dp = zero - data;")
+                lines.append(f"{indent}}}")
+            else:
+                lines.append(f"{indent}while(data[dp]) {{ dp += {arg}; CHECK(dp); }}")
+        elif kind == OP_JZ:
+            lines.append(f"{indent}while(data[dp]) {{")
+            depth += 1
+        elif kind == OP_JNZ:
+            depth -= 1
+            lines.append(f"{'    ' * depth}}}")
+        elif kind == OP_OUT:
+            lines.append(f"{indent}platform_logger_write_char(data[dp]); platform_logger_flush();")
+        elif kind == OP_DBG:
+            lines.append(f"{indent}platform_logger_write_text(\"[dp=\"); platform_logger_write_int((int)dp);")
+            lines.append(f"{indent}platform_logger_write_text(\"] \"); platform_logger_write_int(data[dp]); platform_logger_flush();")
+        elif kind == OP_CALL:
+            lines.append(f"{indent}if(call_native(state, dp) != 0) return -4;")
+        elif kind == OP_RESET:
+            lines.append(f"{indent}dp = 0;")
+        else:
+            lines.append(f"{indent}platform_logger_write_text(\"ERROR: unknown instruction '\"); platform_logger_write_char({ord(arg)});")
+            lines.append(f"{indent}platform_logger_write_char('\\''); platform_logger_flush();")
+            lines.append(f"{indent}return -1;")
+    lines.append("    state->dp = (size_t)dp;")
+    lines.append("    return 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def call_native(state: State, dp: int) -> Optional[int]:
+    """
+    Call the native function whose slot index is stored at data[dp].
+    The 8 cells before it are the arguments, nearest cell first.
+    The return value is written back into data[dp].
+    """
+    data = state.data
+    pfn = data[dp]
+    func = state.natives[pfn]
+    if func is None:
+        state.write_text(f"ERROR: invalid native function with index {pfn}")
+        state.flush()
+        return None
+    args = bytes(data[dp - i] if dp - i >= 0 else 0 for i in range(1, 9))
+    result = func(state, args) & 0xFF
+    data[dp] = result
+    return result
+
+# Natives behind `bfcat2.py com --native-ops`, registered from
+# BFCAT_NATIVE_BASE onward in this order (same as register_bfcat_natives
+# in src/bfpp.c). They work on the bfcat stack in place: the slot index is
+# pushed on top of the operands, the native replaces the operands with its
+# result and returns 0 so the slot cell is left cleared.
+BFCAT_NATIVE_BASE = 240
+BFCAT_ARRAY_STRIDE = 3
+
+def bfcat_binary(op: Callable[[int, int], int]) -> NativeFunc:
+    def native(state: State, args: bytes) -> int:
+        # [ ..., Y, X, SLOT ] => [ ..., Y op X ]
+        state.data[state.dp - 2] = op(args[1], args[0]) & 0xFF
+        state.data[state.dp - 1] = 0
+        return 0
+    return native
+
+def bfcat_array_get(state: State, args: bytes) -> int:
+    # [ ..., INDEX, HI, LO, SLOT ] => [ ..., VALUE ] where HI and LO are the
+    # address of the first element
+    at = ((args[1] << 8) | args[0]) - args[2] * BFCAT_ARRAY_STRIDE
+    value = state.data[at] if 0 <= at < len(state.data) else 0
+    state.data[state.dp - 3] = value
+    state.data[state.dp - 2] = 0
+    state.data[state.dp - 1] = 0
+    return 0
+
+def bfcat_array_set(state: State, args: bytes) -> int:
+    # [ ..., INDEX, VALUE, HI, LO, SLOT ] => [ ... ]
+    at = ((args[1] << 8) | args[0]) - args[3] * BFCAT_ARRAY_STRIDE
+    if 0 <= at < len(state.data):
+        state.data[at] = args[2]
+    for i in range(1, 5):
+        state.data[state.dp - i] = 0
+    return 0
+
+def bfcat_divmod(state: State, args: bytes) -> int:
+    # [ ..., Y, X, SLOT ] => [ ..., Y / X, Y % X ]
+    y, x = args[1], args[0]
+    state.data[state.dp - 2] = y // x if x != 0 else 0
+    state.data[state.dp - 1] = y % x if x != 0 else y
+    return 0
+
+BFCAT_NATIVES = {
+    "eq":  bfcat_binary(lambda y, x: int(y == x)),
+    "neq": bfcat_binary(lambda y, x: int(y != x)),
+    "gt":  bfcat_binary(lambda y, x: int(y > x)),
+    "lt":  bfcat_binary(lambda y, x: int(y < x)),
+    "mul": bfcat_binary(lambda y, x: y * x),
+    # Division by zero gives 0 and leaves the whole dividend as remainder
+    "div": bfcat_binary(lambda y, x: y // x if x != 0 else 0),
+    "mod": bfcat_binary(lambda y, x: y % x if x != 0 else y),
+    "array_get": bfcat_array_get,
+    "array_set": bfcat_array_set,
+    "divmod": bfcat_divmod,
+    "shl": bfcat_binary(lambda y, x: y << x if x < 8 else 0),
+    "shr": bfcat_binary(lambda y, x: y >> x if x < 8 else 0),
+}
+
+def register_bfcat_natives(state: State):
+    for i, func in enumerate(BFCAT_NATIVES.values()):
+        state.natives[BFCAT_NATIVE_BASE + i] = func
+
+def raylib_init_window(state: State, args: bytes) -> int:
+    width  = (args[0] << 8) | args[1]
+    height = (args[2] << 8) | args[3]
+    end = state.data.find(0, args[4])
+    title = state.data[args[4]:end].decode("latin-1")
+    state.write_text(f"Creating window({title}, {width}, {height})")
+    return 0
+
+def raylib_stub(state: State, args: bytes) -> int:
+    return 0
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 2:
+        print("Error: Provide a valid input filepath", file=sys.stderr)
+        print("Usage: bfpp.py <input.bf|input.bfb>", file=sys.stderr)
+        return -2
+
+    with open(argv[1], "rb") as file:
+        program = file.read()
+    bytecode = None
+    tape_length = TAPE_LENGTH
+    if program.startswith(BYTECODE_MAGIC):
+        bytecode = load_bytecode(program)
+        tape_length = bytecode.tape_size or TAPE_LENGTH
+
+    state = State(tape_length=tape_length)
+    state.natives[0] = raylib_init_window
+    state.natives[1] = raylib_stub
+    state.natives[2] = raylib_stub
+    state.natives[3] = raylib_stub
+    state.natives[4] = raylib_stub
+    register_bfcat_natives(state)
+    if bytecode is not None:
+        return eval_ops(state, bytecode.ops)
+    return eval_program(state, program.decode())
+
+if __name__ == "__main__":
+    exit(main(sys.argv))
@@ -1,84 +1,372 @@
+import io
 import os
+import sys
+import time
 import subprocess
 import json
+import shutil
 import optparse
+import tempfile
+import contextlib
+import concurrent.futures
 
-SILENT = True
+import bfpp
+import bfcat2
 
-def cmd(command: list[str], show_stdout = False, show_stderr = True) -> bool:
-    if not SILENT:
-        print(command)
-    result = subprocess.run(command, 
-                            stdout=subprocess.PIPE if not show_stdout else None, 
-                            stderr=subprocess.PIPE if not show_stderr else None,
-                            text=True)
-    return result.returncode == 0
+# Compile times this close to their baseline never count as a regression,
+# short compiles are noisy, even more so with every core busy
+TIME_SLACK = 0.1
+
+# Every test also runs without constant folding and specialized templates,
+# otherwise most of them never exercise the generic intrinsic templates,
+# and once more with the intrinsics lowered to the bfcat natives and with
+# the loops unrolled
+CONFIGURATIONS = [
+    ("", {}),
+    ("-generic", { "fold": False, "specialize": False, "fuse": False }),
+    ("-native", { "native_ops": True, "fold": False, "specialize": False }),
+    ("-unroll", { "unroll": True }),
+]
+
+def run_bfpp(program_path: str) -> tuple[str, int]:
+    # Steps are the ops bfpp.eval_program dispatches, fused loops count once
+    with open(program_path, "r") as file:
+        program = file.read()
+    state = bfpp.State(io.StringIO())
+    bfpp.register_bfcat_natives(state)
+    bfpp.eval_program(state, program)
+    return state.output.getvalue(), state.steps
+
+def run_bfpp_steps(program_path: str) -> tuple[str, int]:
+    # Every BF character counts as a step, like the C interpreter runs it
+    with open(program_path, "r") as file:
+        program = file.read()
+    state = bfpp.State(io.StringIO())
+    bfpp.register_bfcat_natives(state)
+    bfpp.eval_ops(state, bfpp.lower(program, optimize=False))
+    return state.output.getvalue(), state.steps
+
+def check_baseline(output_path: str, baseline: dict, measured: dict, threshold: float, time_threshold: float) -> bool:
+    # Fail when a measure grows past its baseline by more than the threshold
+    # (in percent). Compile times are noisy so they get their own threshold
+    success = True
+    for key in [ "size", "steps", "compile_time" ]:
+        if key not in baseline:
+            continue
+        limit = time_threshold if key == "compile_time" else threshold
+        slack = TIME_SLACK if key == "compile_time" else 0
+        if measured[key] > baseline[key] * (1 + limit / 100) + slack:
+            change = 100 * (measured[key] - baseline[key]) / baseline[key] if baseline[key] else float("inf")
+            print(f"+ {output_path} regressed: {key} went from {baseline[key]} to {measured[key]} (+{change:.1f}%)")
+            success = False
+    return success
+
+def check_peephole(before_path: str, after_path: str) -> bool:
+    before_stdout, before_steps = run_bfpp_steps(before_path)
+    after_stdout, after_steps = run_bfpp_steps(after_path)
+    with open(before_path, "r") as before, open(after_path, "r") as after:
+        unchanged = before.read() == after.read()
+    if before_stdout != after_stdout:
+        print(f"+ {after_path} peephole failed: the output changed")
+        print(f"++ Without peephole:")
+        print(before_stdout)
+        print(f"++ With peephole:")
+        print(after_stdout)
+        return False
+    if after_steps > before_steps or (after_steps == before_steps and not unchanged):
+        print(f"+ {after_path} peephole failed: {before_steps} steps before and {after_steps} after")
+        return False
+    print(f"+ {after_path} peephole success ({before_steps} -> {after_steps} steps)")
+    return True
+
+def check_report() -> bool:
+    # Line 6 of the divmod demo, `dup 7 divmod`, runs once for every value
+    # the while around it counts down. The steps `com --report` gives the
+    # line for those values must cover what it runs, and not by much more
+    test_path = os.path.join("demos", "19_test_divmod.bfc")
+    line_number = 6
+    values = [ 200, 150, 100, 50 ]
+    with open(test_path, "r") as file:
+        source = file.read()
+    codegen = bfcat2.make_codegen(source, bfcat2.CompileOptions(), test_path)
+    program = codegen.emit_all()
+    cost = bfcat2.report_lines(codegen, program, bfcat2.piece_extents(codegen))[("", line_number)][1]
+    reported = sum(bfcat2.cost_worst(cost, value) for value in values)
+    positions = []
+    ops = bfpp.lower(program, False, positions)
+    state = bfpp.State(io.StringIO())
+    bfpp.register_bfcat_natives(state)
+    _, counts = bfpp.profile_ops(state, ops)
+    measured = 0
+    for ip, count in enumerate(counts):
+        origin = codegen.source_map.lookup(positions[ip])
+        if origin is not None and origin[2] == line_number and origin[5] == "":
+            measured += count
+    if not measured <= reported <= 2 * measured:
+        print(f"+ {test_path}:{line_number} report failed: {bfcat2.cost_text(cost)} gives {reported} steps, {measured} ran")
+        return False
+    print(f"+ {test_path}:{line_number} report success ({reported} steps reported, {measured} ran)")
+    return True
+
+def check_cache() -> bool:
+    # compile_file on a copy of the load demo with a cache of its own: a
+    # second compile is a hit, other options and an edited module miss and
+    # give what compiling without the cache gives, and the cache stays
+    # within its limit
+    test_path = os.path.join("demos", "22_test_load.bfc")
+    saved = bfcat2.COMPILE_CACHE_DIR, bfcat2.COMPILE_CACHE_LIMIT, bfcat2.make_codegen
+    compiles = []
+    def make_codegen(*args):
+        compiles.append(args)
+        return saved[2](*args)
+    def compile(options: bfcat2.CompileOptions, cache: bool = True) -> str:
+        bfcat2.compile_file(source_path, output_path, options, cache=cache)
+        with open(output_path, "r") as file:
+            return file.read()
+    def cache_size() -> int:
+        return sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+    problems = []
+    # compile_file prints the program offset
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        source_path = os.path.join(directory, os.path.basename(test_path))
+        output_path = os.path.join(directory, "output.bf")
+        cache_dir = os.path.join(directory, "cache")
+        module_path = os.path.join(directory, "modules", "util.bfc")
+        shutil.copyfile(test_path, source_path)
+        shutil.copytree(os.path.join("demos", "modules"), os.path.join(directory, "modules"),
+                        ignore=shutil.ignore_patterns("*.bfm"))
+        bfcat2.COMPILE_CACHE_DIR = cache_dir
+        bfcat2.make_codegen = make_codegen
+        try:
+            first = compile(bfcat2.CompileOptions())
+            if compile(bfcat2.CompileOptions()) != first or len(compiles) != 1:
+                problems.append("the second compile wasn't a hit")
+            unrolled = compile(bfcat2.CompileOptions(unroll=True))
+            if len(compiles) != 2 or unrolled != compile(bfcat2.CompileOptions(unroll=True), cache=False):
+                problems.append("other options didn't miss")
+            with open(module_path, "r") as file:
+                module = file.read()
+            with open(module_path, "w") as file:
+                file.write(module.replace("def SQUARE dup mul end", "def SQUARE dup mul 1 add end"))
+            edited = compile(bfcat2.CompileOptions())
+            if edited == first or edited != compile(bfcat2.CompileOptions(), cache=False):
+                problems.append("editing a loaded module didn't miss")
+            bfcat2.COMPILE_CACHE_LIMIT = 3 * len(unrolled)
+            for budget in range(64, 1024, 64):
+                compile(bfcat2.CompileOptions(unroll=True, unroll_budget=budget))
+                if cache_size() > bfcat2.COMPILE_CACHE_LIMIT:
+                    problems.append(f"the cache grew to {cache_size()} bytes past its limit of {bfcat2.COMPILE_CACHE_LIMIT}")
+                    break
+            entries = len(os.listdir(cache_dir))
+        finally:
+            bfcat2.COMPILE_CACHE_DIR, bfcat2.COMPILE_CACHE_LIMIT, bfcat2.make_codegen = saved
+    if problems:
+        print(f"+ {test_path} cache failed: {', '.join(problems)}")
+        return False
+    print(f"+ {test_path} cache success ({len(compiles)} compiles, {entries} entries kept)")
+    return True
+
+WATCH_SOURCE = """def COUNTDOWN
+    while dup 0 gt do
+        1 sub
+        dup dbgprint
+    end
+end
+3 COUNTDOWN pop
+5 while dup 0 gt do
+    dup COUNTDOWN pop
+    1 sub
+end
+pop
+7 2 add dbgprint
+"""
+WATCH_EDITS = [
+    ("7 2 add dbgprint", "7 3 add dbgprint"),
+    # Inside the loop of a macro, every expansion changes
+    ("        1 sub\n        dup", "        2 sub\n        dup"),
+    ("    1 sub\nend", "    dup 1 add pop 1 sub\nend"),
+]
+
+def check_watch() -> bool:
+    # Watcher.update after every edit of WATCH_SOURCE gives the same bytes
+    # as compile_file, in every configuration
+    problems = []
+    parsed = []
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        source_path = os.path.join(directory, "watch.bfc")
+        output_path = os.path.join(directory, "watch.bf")
+        for suffix, config in CONFIGURATIONS:
+            options = bfcat2.CompileOptions(**config)
+            watcher = bfcat2.Watcher(options, source_path)
+            source = WATCH_SOURCE
+            watcher.update(source)
+            for old, new in WATCH_EDITS:
+                source = source.replace(old, new, 1)
+                with open(source_path, "w") as file:
+                    file.write(source)
+                output = watcher.update(source)
+                parsed.append(watcher.parsed)
+                bfcat2.compile_file(source_path, output_path, options, cache=False)
+                with open(output_path, "r") as file:
+                    if file.read() != output:
+                        problems.append(f"`{new.strip()}`{suffix}")
+    if problems:
+        print(f"+ watch failed: the output after {', '.join(problems)} isn't what com gives")
+        return False
+    print(f"+ watch success ({len(parsed)} edits, {max(parsed)} chunks parsed again at most)")
+    return True
+
+# Checks of the compiler that don't come down to running a demo, they
+# count like the tests and run with the whole suite
+CHECKS = [ check_report, check_cache, check_watch ]
+
+def discover_tests(tests_dir: str, expected: dict, build_expectation: bool, names: list[str]) -> list[str]:
+    # Every demo with an expectation is a test. Building the expectation
+    # also picks up the demos named like tests that don't have one yet
+    tests = []
+    for test_file in sorted(os.listdir(tests_dir)):
+        if not test_file.endswith(".bfc"):
+            continue
+        if test_file not in expected and not (build_expectation and "_test_" in test_file):
+            continue
+        if names and not any(name in test_file for name in names):
+            continue
+        tests.append(test_file)
+    return tests
+
+def run_test(test_path: str, output_path: str, config: dict, peephole: bool, use_exe: bool) -> dict:
+    # Compile and run one configuration of a test in a worker. What it
+    # prints is kept in "log" so that tests running at the same time don't
+    # mix their output
+    result = { "error": False }
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            with open(test_path, "r") as file:
+                source = file.read()
+            start = time.perf_counter()
+            program = bfcat2.compile_to_brainfuck(source, options=bfcat2.CompileOptions(**config), path=test_path)
+            result["compile_time"] = time.perf_counter() - start
+            with open(output_path, "w") as file:
+                file.write(program)
+            if peephole:
+                before_path = os.path.splitext(output_path)[0] + "-nopeephole.bf"
+                with open(before_path, "w") as file:
+                    file.write(bfcat2.compile_to_brainfuck(source, options=bfcat2.CompileOptions(peephole=False, **config), path=test_path))
+                check_peephole(before_path, output_path)
+            start = time.perf_counter()
+            stdout, result["steps"] = run_bfpp(output_path)
+            result["run_time"] = time.perf_counter() - start
+            if use_exe:
+                res = subprocess.run([os.path.join("build", "bfpp.exe"), output_path], stdout=subprocess.PIPE)
+                stdout = res.stdout.decode()
+            result["stdout"] = stdout.strip()
+            result["size"] = sum(1 for ch in program if ch in "+-<>[].?$!")
+        except SystemExit:
+            # bfcat2.error reports the error and exits
+            result["error"] = True
+        except Exception as e:
+            # Anything else the compiler or bfpp raised only fails this test
+            print(f"ERROR: {type(e).__name__}: {e}")
+            result["error"] = True
+    result["log"] = log.getvalue()
+    return result
 
 def main():
-    parser = optparse.OptionParser()
-    parser = optparse.OptionParser()
-    parser.add_option("--build-expectation", dest="build_expectation", default=False, help="Don't display warning messages", action="store_true")
-    options, _ = parser.parse_args()
+    parser = optparse.OptionParser(usage="runtest.py [options] [test...]")
+    parser.add_option("--build-expectation", dest="build_expectation", default=False, help="Record the current output, code size, steps and compile time of every test as the expectation", action="store_true")
+    parser.add_option("--threshold", dest="threshold", default=5.0, type="float", help="Fail a test whose code size or steps grow by more than this percent over the baseline (default 5)")
+    parser.add_option("--time-threshold", dest="time_threshold", default=100.0, type="float", help="Same as --threshold for the compile time (default 100)")
+    parser.add_option("--check-peephole", dest="check_peephole", default=False, help="Also check that the peephole pass keeps the output and lowers the step count", action="store_true")
+    parser.add_option("--exe", dest="use_exe", default=False, help="Run the tests with build/bfpp.exe instead of the in-process interpreter", action="store_true")
+    parser.add_option("-j", "--jobs", dest="jobs", default=0, type="int", help="Number of tests to run at the same time (default: one per core)")
+    options, names = parser.parse_args()
 
     build_dir = "build"
     tests_dir = "demos"
-    test_files = [
-        "00_test_dbgprint.bfc",
-        "01_test_dup.bfc",
-        "02_test_over.bfc",
-        "03_test_swap.bfc",
-        "04_test_add.bfc",
-        "05_test_sub.bfc",
-        "06_test_eq.bfc",
-        "07_test_neq.bfc",
-        "08_test_gt.bfc",
-        "09_test_lt.bfc",
-        "10_test_and.bfc",
-        "11_test_or.bfc",
-        "12_test_while.bfc",
-        "13_test_if.bfc",
-        "14_test_if_else.bfc",
-    ]
-
-    with open(os.path.join(tests_dir, "runtest-expectation.json"), "r") as file:
+    expectation_path = os.path.join(tests_dir, "runtest-expectation.json")
+    with open(expectation_path, "r") as file:
         expected = json.loads(file.read())
+    # Per test and configuration: size of the BF, steps it runs (see
+    # run_bfpp) and the compile time in seconds
+    baselines = expected.setdefault("baselines", {})
+    test_files = discover_tests(tests_dir, expected, options.build_expectation, names)
 
-    for test_file in test_files:
-        output_path = os.path.join(build_dir, os.path.splitext(test_file)[0]) + ".bf"
-        # bfcat = os.path.join("tools", "bfcat.py")
-        bfcat = "bfcat2.py"
-        cmd(["python", bfcat, "com", os.path.join(tests_dir, test_file), output_path], show_stdout=True, show_stderr=True)
-        res = subprocess.run([os.path.join(build_dir, "bfpp.exe"), output_path], stdout=subprocess.PIPE)
-        stdout = res.stdout.decode().strip()
-        act_lines = stdout.splitlines()
-        exp_lines = expected[test_file]
-
-        success = True
-        if len(act_lines) != len(exp_lines):
-            print(f"+ {output_path} failed")
-            print(f"++ Actual: {len(act_lines)}")
-            print(stdout)
-            print(f"++ Expected: {len(exp_lines)}")
-            print("\n".join(exp_lines))
-            continue
+    os.makedirs(build_dir, exist_ok=True)
+    # Build the cached constant table once instead of in every worker
+    bfcat2.load_const_table()
+    jobs = options.jobs if options.jobs > 0 else os.cpu_count() or 1
+    passed = 0
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        runs = []
+        for test_file in test_files:
+            for suffix, config in CONFIGURATIONS:
+                output_path = os.path.join(build_dir, os.path.splitext(test_file)[0]) + suffix + ".bf"
+                future = pool.submit(run_test, os.path.join(tests_dir, test_file), output_path, config,
+                                     options.check_peephole, options.use_exe)
+                runs.append((test_file, suffix, output_path, future))
+
+        for test_file, suffix, output_path, future in runs:
+            result = future.result()
+            print(result["log"], end="")
+            if result["error"]:
+                print(f"+ {output_path} failed with an error")
+                failed += 1
+                continue
+            stdout = result["stdout"]
+            size = result["size"]
+            steps = result["steps"]
+            timing = f"compiled in {result['compile_time']:.3f}s, ran in {result['run_time']:.3f}s"
+            measured = { "size": size, "steps": steps, "compile_time": round(result["compile_time"], 4) }
+            if options.build_expectation:
+                if suffix == "":
+                    expected[test_file] = stdout.splitlines()
+                baselines.setdefault(test_file, {})[suffix] = measured
+                print(f"+ {output_path} recorded ({size} chars, {steps} steps, {timing})")
+                continue
+            act_lines = stdout.splitlines()
+            exp_lines = expected[test_file]
 
-        for i in range(len(act_lines)):
-            if act_lines[i] != exp_lines[i]:
-                success = False
-                break
+            if act_lines != exp_lines:
+                print(f"+ {output_path} failed")
+                print(f"++ Actual: {len(act_lines)}")
+                print(stdout)
+                print(f"++ Expected: {len(exp_lines)}")
+                print("\n".join(exp_lines))
+                failed += 1
+                continue
 
+            baseline = baselines.get(test_file, {}).get(suffix)
+            if baseline is not None and not check_baseline(output_path, baseline, measured, options.threshold, options.time_threshold):
+                print(f"+ {output_path} failed")
+                failed += 1
+            else:
+                print(f"+ {output_path} success ({size} chars, {steps} steps, {timing})")
+                passed += 1
+
+    checks = CHECKS if not names and not options.build_expectation else []
+    for check in checks:
+        try:
+            success = check()
+        except Exception as e:
+            print(f"+ {check.__name__} failed with {type(e).__name__}: {e}")
+            success = False
         if success:
-            print(f"+ {output_path} success")
+            passed += 1
         else:
-            print(f"+ {output_path} failed")
-            print(f"++ Actual: {len(act_lines)}")
-            print(stdout)
-            print(f"++ Expected: {len(exp_lines)}")
-            print("\n".join(exp_lines))
+            failed += 1
 
+    print(f"{len(test_files)} tests and {len(checks)} checks, {passed} passed and {failed} failed in {time.perf_counter() - start:.2f}s on {jobs} processes")
+    if options.build_expectation:
+        with open(expectation_path, "w") as file:
+            json.dump(expected, file, indent=4)
+            file.write("\n")
+    if failed > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main()
     pass
-
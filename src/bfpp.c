@@ -6,6 +6,101 @@ void reset_state(State *state)
     internal_memset(state->data, 0, sizeof(state->data));
 }
 
+// Most cells a fused loop may step besides the one it counts down
+#define FUSED_CELLS 16
+
+static int move_off_tape(long dp)
+{
+    if(dp < 0) {
+        platform_logger_write_text("ERROR: data pointer is already zero could not decrement it anymore");
+    } else {
+        platform_logger_write_text("ERROR: data pointer is already maxed could not increment it anymore");
+    }
+    platform_logger_flush();
+    return -5;
+}
+
+// Runs the loop starting at program[state->ip] in one go when its body is
+// only +-<>, like fuse_loop in bfpp.py: a body that only moves is a scan
+// ([>], [<<]...), the one of stride 1 goes through memchr, and a body that
+// comes back to its cell and steps it by -1 or +1 ([-], [->+<],
+// [->+>+<<]...) adds the cell times the step of every other cell and
+// clears it. Returns 1 with state->ip on the matching ']', 0 when the loop
+// has to run instruction by instruction and -5 when it leaves the tape.
+// The loop is only looked at when it is entered so there is nothing to
+// keep per program.
+static int eval_fused_loop(State *state, const char *program, size_t programsz)
+{
+    long offsets[FUSED_CELLS];
+    int deltas[FUSED_CELLS];
+    size_t count = 0;
+    long offset = 0;
+    int step = 0;
+    size_t i = state->ip + 1;
+    for(; i < programsz && program[i] != ']'; ++i) {
+        char inst = program[i];
+        if(inst == '+' || inst == '-') {
+            int delta = inst == '+' ? 1 : -1;
+            if(offset == 0) {
+                step += delta;
+                continue;
+            }
+            size_t k = 0;
+            while(k < count && offsets[k] != offset) k += 1;
+            if(k == count) {
+                if(count == FUSED_CELLS) return 0;
+                offsets[count] = offset;
+                deltas[count] = 0;
+                count += 1;
+            }
+            deltas[k] += delta;
+        } else if(inst == '>' || inst == '<') {
+            offset += inst == '>' ? 1 : -1;
+        } else if(inst == ';') {
+            while(i + 1 < programsz && program[i + 1] != '\n') i += 1;
+        } else if(inst != ' ' && inst != '\t' && inst != '\r' && inst != '\n') {
+            return 0;
+        }
+    }
+    // An unmatched '[' is reported by the usual path
+    if(i >= programsz) return 0;
+
+    long dp = (long)state->dp;
+    if(offset != 0) {
+        if((step & 0xFF) != 0) return 0;
+        for(size_t k = 0; k < count; ++k) {
+            if((deltas[k] & 0xFF) != 0) return 0;
+        }
+        if(offset == 1) {
+            const Byte *zero = internal_memchr(&state->data[dp], 0, TAPE_LENGTH - dp);
+            if(zero == NULL) return move_off_tape(TAPE_LENGTH);
+            dp = zero - state->data;
+        } else {
+            while(state->data[dp] != 0) {
+                dp += offset;
+                if(dp < 0 || dp >= TAPE_LENGTH) return move_off_tape(dp);
+            }
+        }
+    } else {
+        // Stepping by +1 runs the loop 256 - cell times
+        int sign;
+        if((step & 0xFF) == 0xFF) sign = 1;
+        else if((step & 0xFF) == 1) sign = -1;
+        else return 0;
+        Byte value = state->data[dp];
+        for(size_t k = 0; k < count; ++k) {
+            if(dp + offsets[k] < 0 || dp + offsets[k] >= TAPE_LENGTH) return move_off_tape(dp + offsets[k]);
+        }
+        for(size_t k = 0; k < count; ++k) {
+            state->data[dp + offsets[k]] += (Byte)(value * deltas[k] * sign);
+        }
+        state->data[dp] = 0;
+    }
+    state->dp = (size_t)dp;
+    state->ip = i;
+    return 1;
+}
+
 int eval_program(State *state, const char *program, size_t programsz)
 {
     state->dp = 0;
@@ -42,15 +137,11 @@ int eval_program(State *state, const char *program, size_t programsz)
                 break;
             case '[':
                 {
-                    // Optimization Idea: check if program[ip + 1] == '-' && program[ip + 2] == ']'
-                    // Then we can just set data[dp] = 0
-                    if(state->ip + 2 < programsz && program[state->ip + 1] == '-' && program[state->ip + 2] == ']') {
-                        state->data[state->dp] = 0;
-                        state->ip += 2; // skip over -];
-                        break;
-                    }
-
-                    if(state->data[state->dp] == 0) {
+                    if(state->data[state->dp] != 0) {
+                        // Into the body unless the loop runs in one go
+                        int fused = eval_fused_loop(state, program, programsz);
+                        if(fused < 0) return fused;
+                    } else {
                         size_t i = state->ip;
                         size_t stack = 0;
                         for(; i < programsz; ++i) {
@@ -88,8 +179,8 @@ int eval_program(State *state, const char *program, size_t programsz)
                             platform_logger_flush();
                             return -3;
                         }
-                        size_t jmp = (size_t)i;
-                        state->ip = jmp - 1;
+                        // Straight back into the body, the cell isn't 0
+                        state->ip = (size_t)i;
                     }
                 } break;
             
@@ -116,10 +207,9 @@ int eval_program(State *state, const char *program, size_t programsz)
                         platform_logger_flush();
                         return -4;
                     }
-                    edp -= 1;
                     Byte a[8] = {0};
-                    for(int i = 7; i >= 0; i--, edp--) {
-                        a[8 - i - 1] = state->data[edp];
+                    for(size_t i = 0; i < 8 && i < edp; ++i) {
+                        a[i] = state->data[edp - 1 - i];
                     }
                     state->data[state->dp] = state->natives[(int)pfn](state, a);
                     // Calling native function
@@ -127,7 +217,7 @@ int eval_program(State *state, const char *program, size_t programsz)
 
             // Comments
             case ';':
-                while(program[state->ip] != '\n') {
+                while(state->ip + 1 < programsz && program[state->ip + 1] != '\n') {
                     state->ip += 1;
                 }
                 break;
@@ -156,6 +246,111 @@ int eval_program(State *state, const char *program, size_t programsz)
     return 0;
 }
 
+// The bfcat natives work on the stack in place. The slot index is pushed
+// on top of the operands, the native replaces the operands with its
+// result and returns 0 so the slot cell is left cleared.
+#define BFCAT_ARRAY_STRIDE 3
+
+static Byte bfcat_binary_result(State *state, Byte result)
+{
+    // [ ..., Y, X, SLOT ] => [ ..., RESULT ]
+    state->data[state->dp - 2] = result;
+    state->data[state->dp - 1] = 0;
+    return 0;
+}
+
+static Byte bfcat_eq(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[1] == args[0]);
+}
+
+static Byte bfcat_neq(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[1] != args[0]);
+}
+
+static Byte bfcat_gt(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[1] > args[0]);
+}
+
+static Byte bfcat_lt(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[1] < args[0]);
+}
+
+static Byte bfcat_mul(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, (Byte)(args[1] * args[0]));
+}
+
+// Division by zero gives 0 and leaves the whole dividend as remainder
+static Byte bfcat_div(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[0] ? args[1] / args[0] : 0);
+}
+
+static Byte bfcat_mod(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[0] ? args[1] % args[0] : args[1]);
+}
+
+static Byte bfcat_divmod(State *state, Byte args[8])
+{
+    // [ ..., Y, X, SLOT ] => [ ..., Y / X, Y % X ]
+    state->data[state->dp - 2] = args[0] ? args[1] / args[0] : 0;
+    state->data[state->dp - 1] = args[0] ? args[1] % args[0] : args[1];
+    return 0;
+}
+
+static Byte bfcat_shl(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[0] < 8 ? (Byte)(args[1] << args[0]) : 0);
+}
+
+static Byte bfcat_shr(State *state, Byte args[8])
+{
+    return bfcat_binary_result(state, args[0] < 8 ? args[1] >> args[0] : 0);
+}
+
+static long bfcat_element(Byte args[8], Byte index)
+{
+    // args[1] and args[0] are the address of the first element
+    return (((long)args[1] << 8) | (long)args[0]) - (long)index * BFCAT_ARRAY_STRIDE;
+}
+
+static Byte bfcat_array_get(State *state, Byte args[8])
+{
+    // [ ..., INDEX, HI, LO, SLOT ] => [ ..., VALUE ]
+    long at = bfcat_element(args, args[2]);
+    state->data[state->dp - 3] = (at >= 0 && at < TAPE_LENGTH) ? state->data[at] : 0;
+    state->data[state->dp - 2] = 0;
+    state->data[state->dp - 1] = 0;
+    return 0;
+}
+
+static Byte bfcat_array_set(State *state, Byte args[8])
+{
+    // [ ..., INDEX, VALUE, HI, LO, SLOT ] => [ ... ]
+    long at = bfcat_element(args, args[3]);
+    if(at >= 0 && at < TAPE_LENGTH) state->data[at] = args[2];
+    for(size_t i = 1; i <= 4; ++i) state->data[state->dp - i] = 0;
+    return 0;
+}
+
+void register_bfcat_natives(State *state)
+{
+    NativeFunc natives[] = {
+        bfcat_eq, bfcat_neq, bfcat_gt, bfcat_lt,
+        bfcat_mul, bfcat_div, bfcat_mod,
+        bfcat_array_get, bfcat_array_set,
+        bfcat_divmod, bfcat_shl, bfcat_shr,
+    };
+    for(size_t i = 0; i < sizeof(natives)/sizeof(natives[0]); ++i) {
+        state->natives[BFCAT_NATIVE_BASE + i] = natives[i];
+    }
+}
+
 size_t internal_strlen(const char *cstr)
 {
     size_t size;
@@ -177,6 +372,21 @@ void *internal_memcpy(void *dst, const void *src, size_t size)
     return dst;
 }
 
+#ifdef BFPP_WASM
+void *internal_memchr(const void *src, const int value, size_t size)
+{
+    for(size_t i = 0; i < size; ++i)
+        if(((const Byte *)src)[i] == (Byte)value) return (void *)&((const Byte *)src)[i];
+    return NULL;
+}
+#else
+#include <string.h>
+void *internal_memchr(const void *src, const int value, size_t size)
+{
+    return memchr(src, value, size);
+}
+#endif
+
 #ifndef BFPP_WASM
 #include <stdio.h>
 void platform_logger_write_text(const char *text)
@@ -21,6 +21,7 @@ typedef struct State {
 size_t internal_strlen(const char *cstr);
 void *internal_memset(void *dst, const int value, size_t size);
 void *internal_memcpy(void *dst, const void *src, size_t size);
+void *internal_memchr(const void *src, const int value, size_t size);
 
 void platform_logger_write_text(const char *text);
 void platform_logger_write_char(Byte ch);
@@ -28,6 +29,14 @@ void platform_logger_write_int(int value);
 void platform_logger_flush(void);
 
 int eval_program(State *state, const char *program, size_t programsz);
+// Provided by the output of `bfcat2.py com --target c`
+int eval_compiled(State *state);
 void reset_state(State *state);
 
+// Natives behind `bfcat2.py com --native-ops`, registered from
+// BFCAT_NATIVE_BASE onward. Keep them in the same order as BFCAT_NATIVES
+// in bfpp.py
+#define BFCAT_NATIVE_BASE 240
+void register_bfcat_natives(State *state);
+
 #endif // BFPP_H_
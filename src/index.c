@@ -35,6 +35,7 @@ void _start(void)
     reset_state(&state);
     state.natives[0] = f_clear_background;
     state.natives[1] = f_draw_cell;
+    register_bfcat_natives(&state);
 
     platform_logger_write_text("Start function called");
     platform_logger_flush();
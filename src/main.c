@@ -65,11 +65,13 @@ Byte raylib_end_drawing(State *stae, Byte args[8])
 
 int main(int argc, const char **argv)
 {
+#ifndef BFPP_COMPILED
     if(argc < 2) {
         fprintf(stderr, "Error: Provide a valid input filepath\n");
         fprintf(stderr, "Usage: bfpp <input.bf>\n");
         return -2;
     }
+#endif
 
     State state = {0};
     memset(state.natives, 0, sizeof(state.natives));
@@ -78,6 +80,14 @@ int main(int argc, const char **argv)
     state.natives[2] = raylib_window_should_close;
     state.natives[3] = raylib_begin_drawing;
     state.natives[4] = raylib_end_drawing;
+    register_bfcat_natives(&state);
+#ifdef BFPP_COMPILED
+    // The program was transpiled to C and linked in
+    (void)argc;
+    (void)argv;
+    return eval_compiled(&state);
+#else
     const char *program = load_file_content(argv[1]);
     return eval_program(&state, program, strlen(program));
+#endif
 }
@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import optparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bfcat2
+
+# Front end benchmark: tokenizing and parsing generated bfcat sources of
+# 10^4 up to 10^7 tokens. Every size is measured twice, once for time and
+# once under tracemalloc for the peak memory (tracemalloc slows it down).
+
+# A macro, an array and a loop with a branch in it, then straight-line code
+CHUNK = """def STEP 1 add dup 3 mod end
+array buf 8 end
+0 while dup 10 lt do
+    STEP
+    if dup 2 eq do 7 !buf else ?buf pop end
+    swap over swap pop
+end pop
+"""
+
+def generate(tokens: int) -> str:
+    per_chunk = len(bfcat2.parse_tokens(CHUNK))
+    return CHUNK * max(tokens // per_chunk, 1)
+
+def front_end(source: str):
+    bfcat2.Parser(bfcat2.parse_tokens(source)).parse()
+
+def measure(source: str) -> tuple[int, float, float, int]:
+    start = time.perf_counter()
+    tokens = bfcat2.parse_tokens(source)
+    scanned = time.perf_counter()
+    bfcat2.Parser(tokens).parse()
+    parsed = time.perf_counter()
+    count = len(tokens)
+    del tokens
+    tracemalloc.start()
+    front_end(source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, scanned - start, parsed - scanned, peak
+
+def main():
+    parser = optparse.OptionParser(usage="frontbench.py [--min N] [--max N]")
+    parser.add_option("--min", dest="min", default=4, type="int", help="Smallest size as a power of 10 (default 4)")
+    parser.add_option("--max", dest="max", default=7, type="int", help="Largest size as a power of 10 (default 7)")
+    options, _ = parser.parse_args()
+
+    print(f"{'tokens':>10} {'source':>9} {'scan tok/s':>12} {'parse tok/s':>12} {'total tok/s':>12} {'peak':>10}")
+    for exponent in range(options.min, options.max + 1):
+        source = generate(10 ** exponent)
+        count, scan, parse, peak = measure(source)
+        print(f"{count:>10} {len(source) / 2**20:>7.1f}MB {count / scan:>12.0f} {count / parse:>12.0f} " +
+              f"{count / (scan + parse):>12.0f} {peak / 2**20:>8.1f}MB")
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()